@@ -0,0 +1,177 @@
+"""
+Columnar event analytics: amounts, dates and activities held in compact
+array buffers, aggregated without building a Python object per event.
+
+Amounts are integer cents, so every total is exact. When NumPy is installed
+the aggregations run vectorized over the same buffers without copying them;
+without it they fall back to the standard library and give identical results.
+"""
+import array
+import bisect
+import datetime
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Day numbers count days since this date, as datetime64[D] values do
+EPOCH = datetime.date(1970, 1, 1)
+
+
+def day_number(date):
+    """
+    Converts a date to the number of days since EPOCH
+    :param date: datetime.date or ISO-8601 string
+    :return: the day number
+    """
+    if not isinstance(date, datetime.date):
+        date = datetime.datetime.strptime(date, '%Y-%m-%d').date()
+    return date.toordinal() - EPOCH.toordinal()
+
+
+def _month(day):
+    """
+    Returns the YYYY-MM month of a day number
+    """
+    return datetime.date.fromordinal(day + EPOCH.toordinal()).strftime('%Y-%m')
+
+
+class EventColumns:
+    """
+    Amount, day and activity of a set of events, one signed 64-bit array per
+    column with one entry per event
+    """
+    def __init__(self):
+        self.amount_cents = array.array('q')
+        self.days = array.array('q')
+        self.activity_ids = array.array('q')
+
+    def __len__(self):
+        return len(self.amount_cents)
+
+    def extend(self, rows):
+        """
+        Appends events to the columns
+        :param rows: iterable of (amount_cents, day, activity_id) tuples,
+        where day is a day number
+        """
+        rows = list(rows)
+        self.amount_cents.extend(row[0] for row in rows)
+        self.days.extend(row[1] for row in rows)
+        self.activity_ids.extend(row[2] for row in rows)
+
+    def _column(self, column):
+        """
+        Returns a column as a NumPy view sharing the array's memory, or the
+        array itself without NumPy
+        """
+        if numpy is None:
+            return column
+        return numpy.frombuffer(column, dtype=numpy.int64)
+
+    def total_cents(self):
+        """
+        Returns the sum of the amounts
+        :return: total in cents
+        """
+        if numpy is None or not self:
+            return sum(self.amount_cents)
+        return int(self._column(self.amount_cents).sum())
+
+    def mean_cents(self):
+        """
+        Returns the mean amount
+        :return: mean in cents, or None if there are no events
+        """
+        if not self:
+            return None
+        return self.total_cents() / len(self)
+
+    def percentile_cents(self, percent):
+        """
+        Returns a percentile of the amounts by the nearest-rank method, so the
+        result is always one of the amounts
+        :param percent: percentile between 0 and 100
+        :return: the amount in cents, or None if there are no events
+        """
+        if not 0 <= percent <= 100:
+            raise ValueError('invalid percentile: ' + repr(percent))
+        if not self:
+            return None
+
+        rank = max(1, -(-len(self) * percent // 100))
+        index = int(rank) - 1
+        if numpy is None:
+            return sorted(self.amount_cents)[index]
+        amounts = self._column(self.amount_cents)
+        return int(numpy.partition(amounts, index)[index])
+
+    def histogram(self, edges):
+        """
+        Counts the amounts falling in each bin. Bins are half open,
+        [edges[i], edges[i + 1]), except the last, which includes its upper
+        edge; amounts outside every bin are not counted
+        :param edges: ascending bin edges in cents
+        :return: list of len(edges) - 1 counts
+        """
+        edges = list(edges)
+        if len(edges) < 2 or edges != sorted(edges):
+            raise ValueError('bin edges must be ascending')
+
+        if numpy is not None:
+            counts, _ = numpy.histogram(self._column(self.amount_cents),
+                                        bins=numpy.array(edges))
+            return [int(count) for count in counts]
+
+        counts = [0] * (len(edges) - 1)
+        for amount in self.amount_cents:
+            if amount == edges[-1]:
+                counts[-1] += 1
+            elif edges[0] <= amount < edges[-1]:
+                counts[bisect.bisect_right(edges, amount) - 1] += 1
+        return counts
+
+    def _totals_by(self, keys):
+        """
+        Sums the amounts per distinct key
+        :param keys: array with one key per event
+        :return: dict mapping each key to (count, total_cents)
+        """
+        if numpy is None:
+            totals = {}
+            for key, amount in zip(keys, self.amount_cents):
+                count, total = totals.get(key, (0, 0))
+                totals[key] = (count + 1, total + amount)
+            return totals
+
+        keys = self._column(keys)
+        order = numpy.argsort(keys, kind='stable')
+        unique, starts, counts = numpy.unique(
+            keys[order], return_index=True, return_counts=True)
+        if not len(unique):
+            return {}
+        sums = numpy.add.reduceat(self._column(self.amount_cents)[order],
+                                  starts)
+        return {int(key): (int(count), int(total))
+                for key, count, total in zip(unique, counts, sums)}
+
+    def totals_by_activity(self):
+        """
+        Sums the amounts per activity
+        :return: dict mapping activity_id to (count, total_cents)
+        """
+        return self._totals_by(self.activity_ids)
+
+    def totals_by_month(self):
+        """
+        Sums the amounts per calendar month
+        :return: dict mapping YYYY-MM to (count, total_cents)
+        """
+        totals = {}
+        for day, (count, total) in self._totals_by(self.days).items():
+            month = _month(day)
+            previous = totals.get(month, (0, 0))
+            totals[month] = (previous[0] + count, previous[1] + total)
+        return totals
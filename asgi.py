@@ -0,0 +1,208 @@
+"""
+ASGI entry point serving the booking API from an event loop.
+
+Connections are accepted and request bodies read on the event loop, so idle
+and slow clients cost a coroutine rather than a thread. The Flask routes, and
+the blocking BookingDB calls inside them, run on a bounded thread pool sized
+to the database connection pool; requests beyond what the pool and its queue
+can hold are turned away with 503 instead of piling up. Once a response has
+started, the rest of a streamed body is read on a separate pool, so a stream
+holding a database connection never needs a thread the requests waiting for
+that connection are blocking. Every route keeps the same contract as under a
+WSGI server:
+
+    uvicorn asgi:app
+"""
+import asyncio
+import concurrent.futures
+import io
+import sys
+
+import main_api
+
+
+# Response to requests arriving while the pool and its queue are full
+OVERLOADED = (503, [(b'content-type', b'application/json'),
+                    (b'retry-after', b'1')],
+              b'{"error": "server busy"}')
+
+_DONE = object()
+
+
+def build_environ(scope, body):
+    """
+    Translates an ASGI HTTP scope into a WSGI environ
+    :param scope: ASGI connection scope
+    :param body: request body as bytes
+    :return: the environ
+    """
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+            continue
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = 'HTTP_' + name
+        if key in environ:
+            separator = '; ' if name == 'COOKIE' else ','
+            value = environ[key] + separator + value
+        environ[key] = value
+
+    return environ
+
+
+class AsyncApp:
+    """
+    ASGI application running a WSGI application on a bounded thread pool
+    """
+    def __init__(self, wsgi_app, max_workers, max_queued=0):
+        """
+        Initializes the application
+        :param wsgi_app: WSGI application to serve
+        :param max_workers: number of threads running requests, and of
+        threads reading streamed response bodies
+        :param max_queued: number of requests allowed to wait for a thread
+        before new ones get 503
+        """
+        self.wsgi_app = wsgi_app
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.in_flight = 0
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers, thread_name_prefix='booking-api')
+        self._streams = concurrent.futures.ThreadPoolExecutor(
+            max_workers, thread_name_prefix='booking-stream')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError('unsupported scope: ' + repr(scope['type']))
+
+    async def _lifespan(self, receive, send):
+        """
+        Handles the server's startup and shutdown events
+        """
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, self._executor.shutdown)
+                await loop.run_in_executor(None, self._streams.shutdown)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _read_body(self, receive):
+        """
+        Reads the whole request body
+        :return: the body as bytes, or None if the client disconnected
+        """
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    async def _http(self, scope, receive, send):
+        """
+        Serves one HTTP request
+        """
+        body = await self._read_body(receive)
+        if body is None:
+            return
+
+        if self.in_flight >= self.max_workers + self.max_queued:
+            status, headers, content = OVERLOADED
+            await send({'type': 'http.response.start', 'status': status,
+                        'headers': headers})
+            await send({'type': 'http.response.body', 'body': content})
+            return
+
+        self.in_flight += 1
+        try:
+            started = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._start, build_environ(scope, body))
+        finally:
+            self.in_flight -= 1
+        await self._send(started, send)
+
+    def _start(self, environ):
+        """
+        Calls the WSGI application and reads the first chunk of the response,
+        by which time start_response has been called
+        :return: (status, headers, result, iterator, first chunk)
+        """
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+
+        result = self.wsgi_app(environ, start_response)
+        iterator = iter(result)
+        first = next(iterator, _DONE)
+        status, headers = started
+
+        return status, headers, result, iterator, first
+
+    async def _send(self, started, send):
+        """
+        Sends a started response chunk by chunk. Reading each chunk on the
+        stream pool keeps streamed responses from blocking the event loop,
+        and from holding request threads between chunks
+        :param started: what _start returned
+        """
+        loop = asyncio.get_running_loop()
+        status, headers, result, iterator, chunk = started
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'),
+                             value.encode('latin-1'))
+                            for name, value in headers],
+            })
+            while chunk is not _DONE:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk,
+                                'more_body': True})
+                chunk = await loop.run_in_executor(
+                    self._streams, next, iterator, _DONE)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(self._streams, result.close)
+
+
+application = main_api.create_app()
+app = AsyncApp(application, application.config['ASYNC_WORKERS'],
+               application.config['ASYNC_MAX_QUEUED'])
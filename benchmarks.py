@@ -0,0 +1,254 @@
+"""
+Benchmarks for the BookingDB layer and the API endpoints.
+
+Seeds a temporary database with synthetic people, activities and events for
+each requested size, times the database methods and the /api routes through
+the Flask test client, and writes the results as JSON so runs can be compared
+across commits:
+
+    python benchmarks.py --sizes 1000,100000 --output before.json
+    python benchmarks.py --sizes 1000,100000 --compare before.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import tempfile
+import time
+
+import booking_db
+import main_api
+
+
+def timed(function, repeat):
+    """
+    Runs a function several times and summarizes how long it took
+    :param function: function taking no arguments
+    :param repeat: number of runs
+    :return: dict with min, median and mean milliseconds
+    """
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        samples.append((time.perf_counter() - start) * 1000)
+
+    return {'min_ms': min(samples), 'median_ms': statistics.median(samples),
+            'mean_ms': statistics.mean(samples)}
+
+
+def seed(db, size, rng):
+    """
+    Fills an empty database with size events spread over size / 10 people
+    and size / 1000 activities, one event per activity per day
+    :param db: BookingDB created with the 'activity' conflict scope
+    :param size: number of events
+    :param rng: random.Random used to pick people
+    :return: (people, activities, start) where start is the first date
+    """
+    people = max(10, size // 10)
+    activities = max(10, size // 1000)
+    start = datetime.date(2000, 1, 1)
+
+    db.import_people(['Person {}'.format(i) for i in range(people)])
+    db.import_activities(['Activity {}'.format(i) for i in range(activities)])
+
+    batch = []
+    for index in range(size):
+        date = start + datetime.timedelta(days=index // activities)
+        batch.append((rng.randint(1, people), index % activities + 1,
+                      date.isoformat(), round(rng.uniform(10, 2000), 2)))
+        if len(batch) == 10000:
+            db.insert_events(batch)
+            batch = []
+    if batch:
+        db.insert_events(batch)
+
+    return people, activities, start
+
+
+def bench_db(db, size, people, activities, start, repeat, rng):
+    """
+    Times the BookingDB methods against a seeded database
+    :return: dict of results by benchmark name
+    """
+    results = {}
+    last_day = start + datetime.timedelta(days=size // activities)
+
+    def insert_single():
+        for _ in range(100):
+            insert_single.day += datetime.timedelta(days=1)
+            db.insert_event(1, 1, insert_single.day.isoformat(), 10.0)
+    insert_single.day = last_day + datetime.timedelta(days=1)
+    result = timed(insert_single, repeat)
+    result['rows_per_s'] = 100 / (result['median_ms'] / 1000)
+    results['insert_event_x100'] = result
+
+    def insert_bulk():
+        events = []
+        for _ in range(1000):
+            insert_bulk.day += datetime.timedelta(days=1)
+            events.append((1, 2, insert_bulk.day.isoformat(), 10.0))
+        db.insert_events(events)
+    insert_bulk.day = last_day + datetime.timedelta(days=1)
+    result = timed(insert_bulk, repeat)
+    result['rows_per_s'] = 1000 / (result['median_ms'] / 1000)
+    results['insert_events_x1000'] = result
+
+    results['overview'] = timed(db.overview, repeat)
+    results['load_event_columns'] = timed(db.load_event_columns, repeat)
+    columns = db.load_event_columns()
+    results['event_columns_aggregate'] = timed(
+        lambda: (columns.total_cents(), columns.percentile_cents(95),
+                 columns.totals_by_activity()), repeat)
+    results['get_event_by_person'] = timed(
+        lambda: db.get_event_by_person(rng.randint(1, people)), repeat * 10)
+    results['get_event_by_activity'] = timed(
+        lambda: db.get_event_by_activity(rng.randint(1, activities)), repeat)
+    days = size // activities
+    results['get_event_by_date'] = timed(
+        lambda: db.get_event_by_date(
+            start + datetime.timedelta(days=rng.randint(0, days))),
+        repeat * 10)
+
+    return results
+
+
+def bench_api(app, size, repeat, rng):
+    """
+    Times the /api routes through the Flask test client
+    :param app: the app, configured for the seeded database
+    :return: dict of results by route
+    """
+    client = app.test_client()
+    routes = {
+        'GET /api/event/?limit=100': lambda: '/api/event/?limit=100',
+        'GET /api/event/?limit=100&after_id=<deep>':
+            lambda: '/api/event/?limit=100&after_id={}'.format(size // 2),
+        'GET /api/person/<id>':
+            lambda: '/api/person/{}'.format(rng.randint(1, 10)),
+        'GET /api/calendar/<year>/<month>': lambda: '/api/calendar/2000/6',
+    }
+    if size <= 100000:
+        routes['GET /api/event/'] = lambda: '/api/event/'
+        routes['GET /api/event/?format=columns'] = \
+            lambda: '/api/event/?format=columns'
+
+    results = {}
+    for name, url in routes.items():
+        def request():
+            response = client.get(url())
+            assert response.status_code == 200, response.status_code
+        results[name] = timed(request, repeat)
+
+    return results
+
+
+def run(sizes, repeat, seed_value):
+    """
+    Runs every benchmark at every size
+    :return: JSON-serializable results
+    """
+    results = {}
+    for size in sizes:
+        directory = tempfile.mkdtemp()
+        try:
+            rng = random.Random(seed_value)
+            filename = os.path.join(directory, 'bench.sqlite')
+            db = booking_db.BookingDB(filename, conflict_scope='activity',
+                                      cache_size=0)
+            db.create_tables()
+
+            start = time.perf_counter()
+            people, activities, first = seed(db, size, rng)
+            seed_s = time.perf_counter() - start
+
+            results[str(size)] = {
+                'seed_s': seed_s,
+                'db': bench_db(db, size, people, activities, first, repeat,
+                               rng),
+            }
+            db.close()
+
+            app = main_api.create_app({'DATABASE': filename,
+                                       'DB_CONFLICT_SCOPE': 'activity',
+                                       'CACHE_SIZE': 0})
+            try:
+                results[str(size)]['api'] = bench_api(app, size, repeat, rng)
+            finally:
+                main_api.close_db()
+        finally:
+            shutil.rmtree(directory)
+
+    return results
+
+
+def git_commit():
+    """
+    Returns the current git commit, or None outside a git checkout
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    """
+    Prints the median time of every benchmark against a previous run
+    :param old: results loaded from a previous run
+    :param new: results of this run
+    """
+    for size, groups in new['results'].items():
+        for group in ('db', 'api'):
+            for name, result in groups[group].items():
+                try:
+                    before = old['results'][size][group][name]['median_ms']
+                except KeyError:
+                    continue
+                after = result['median_ms']
+                print('{:>8} {:<45} {:10.3f} ms -> {:10.3f} ms  x{:.2f}'
+                      .format(size, name, before, after, before / after))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--sizes', default='1000',
+                        help='comma-separated event counts, e.g. '
+                             '1000,100000,1000000')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs per benchmark')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    parser.add_argument('--output', help='file to write JSON results to')
+    parser.add_argument('--compare', help='JSON results of an earlier run')
+    args = parser.parse_args()
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'results': run([int(size) for size in args.sizes.split(',')],
+                       args.repeat, args.seed),
+    }
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(json.load(previous), report)
+    if not args.output and not args.compare:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
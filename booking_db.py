@@ -1,138 +1,1710 @@
+import concurrent.futures
+import datetime
+import decimal
+import functools
+import logging
 import os
+import queue
+import re
 import sqlite3
+import threading
+import time
 from collections import OrderedDict
+from contextlib import contextmanager
+
+import analytics
+
+
+logger = logging.getLogger(__name__)
+
+# PRAGMAs applied to every new connection, in order. WAL lets readers carry on
+# while a booking is being committed, and with WAL synchronous=NORMAL is still
+# safe against application crashes.
+DEFAULT_PRAGMAS = OrderedDict([
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('mmap_size', 268435456),
+    ('cache_size', -16000),
+    ('busy_timeout', 5000),
+    ('foreign_keys', 'ON'),
+])
+
+# Formats accepted for event dates. Dates are stored as ISO-8601 (the first
+# format), which sorts and compares correctly as text so date ranges can be
+# answered from the date index.
+DATE_FORMATS = ('%Y-%m-%d', '%b-%d-%Y', '%B-%d-%Y', '%m/%d/%Y', '%m-%d-%Y')
+
+
+def normalize_date(value):
+    """
+    Converts a date in any of the DATE_FORMATS to ISO-8601
+    :param value: date string, or a datetime.date
+    :return: the date as YYYY-MM-DD
+    """
+    if isinstance(value, datetime.date):
+        return value.strftime(DATE_FORMATS[0])
+    if not isinstance(value, str):
+        raise ValueError('invalid date: ' + repr(value))
+
+    for date_format in DATE_FORMATS:
+        try:
+            parsed = datetime.datetime.strptime(value.strip(), date_format)
+        except ValueError:
+            continue
+        return parsed.strftime(DATE_FORMATS[0])
+
+    raise ValueError('invalid date: ' + repr(value))
+
+
+# Currency of amounts given without one, and the format of currency codes
+DEFAULT_CURRENCY = 'USD'
+
+# Largest value an INTEGER column holds; SQLite integers are signed 64-bit
+MAX_INTEGER = 2 ** 63 - 1
+
+
+def to_cents(amount):
+    """
+    Converts an amount of money to integer minor units (cents), rounding
+    half up. Going through Decimal keeps amounts such as 0.1 or '19.99'
+    exact instead of inheriting the binary float error. Amounts whose cents
+    do not fit an INTEGER column are refused
+    :param amount: int, float, Decimal or numeric string
+    :return: the amount in cents
+    """
+    if isinstance(amount, bool):
+        raise ValueError('invalid amount: ' + repr(amount))
+    try:
+        value = decimal.Decimal(str(amount).strip())
+    except (decimal.InvalidOperation, TypeError):
+        raise ValueError('invalid amount: ' + repr(amount))
+    if not value.is_finite():
+        raise ValueError('invalid amount: ' + repr(amount))
+
+    try:
+        cents = int((value * 100).quantize(decimal.Decimal(1),
+                                           rounding=decimal.ROUND_HALF_UP))
+    except ArithmeticError:
+        raise ValueError('amount out of range: ' + repr(amount))
+    if not -MAX_INTEGER - 1 <= cents <= MAX_INTEGER:
+        raise ValueError('amount out of range: ' + repr(amount))
+    return cents
+
+
+def normalize_currency(currency):
+    """
+    Checks an ISO 4217 currency code
+    :param currency: three letter code, any case, or None for the default
+    :return: the code in upper case
+    """
+    if currency is None:
+        return DEFAULT_CURRENCY
+    if not isinstance(currency, str) or len(currency.strip()) != 3 or \
+            not currency.strip().isalpha():
+        raise ValueError('invalid currency: ' + repr(currency))
+
+    return currency.strip().upper()
+
+
+def _normalize_event_dates(cur):
+    """
+    Migration step rewriting stored event dates to ISO-8601. Dates that
+    cannot be parsed are left untouched
+    :param cur: cursor inside the migration transaction
+    """
+    cur.execute('SELECT event_id, date FROM event')
+    updates = []
+    for event_id, date in cur.fetchall():
+        try:
+            normalized = normalize_date(date)
+        except (AttributeError, ValueError):
+            continue
+        if normalized != date:
+            updates.append((normalized, event_id))
+    cur.executemany('UPDATE event SET date = ? WHERE event_id = ?', updates)
+
+
+def _dedupe_names(table, key):
+    """
+    Builds the statements that merge rows of a table sharing the same name
+    into the row with the lowest id, pointing their events at that row, and
+    then make the name unique
+    :param table: person or activity
+    :param key: primary key column of the table
+    :return: list of SQL statements
+    """
+    duplicates = ('SELECT {1} FROM {0} WHERE name IS NOT NULL AND {1} NOT IN '
+                  '(SELECT MIN({1}) FROM {0} WHERE name IS NOT NULL '
+                  'GROUP BY name)').format(table, key)
+    return [
+        'UPDATE event SET {1} = (SELECT MIN(keep.{1}) FROM {0} AS dup '
+        'JOIN {0} AS keep ON keep.name = dup.name '
+        'WHERE dup.{1} = event.{1}) '
+        'WHERE {1} IN ({2})'.format(table, key, duplicates),
+        'DELETE FROM {0} WHERE {1} IN ({2})'.format(table, key, duplicates),
+        'CREATE UNIQUE INDEX IF NOT EXISTS ux_{0}_name ON {0}(name)'.format(
+            table),
+    ]
+
+
+def _version_triggers(table):
+    """
+    Builds the triggers that bump a table's row in table_version whenever
+    the table is written to
+    :param table: name of the table
+    :return: list of SQL statements
+    """
+    statements = []
+    for operation in ('INSERT', 'UPDATE', 'DELETE'):
+        statements.append(
+            'CREATE TRIGGER IF NOT EXISTS tv_{0}_{1} AFTER {2} ON {0} BEGIN '
+            'UPDATE table_version SET version = version + 1, '
+            "modified = CAST(strftime('%s', 'now') AS INTEGER) "
+            "WHERE name = '{0}'; END".format(table, operation.lower(),
+                                             operation))
+    return statements
+
+
+# Tables whose changes are counted in table_version
+VERSIONED_TABLES = ('person', 'activity', 'event')
+
+
+# Summary tables holding the count and total amount of events per group, kept
+# up to date by triggers on event so reports never scan the event table
+REPORT_TABLES = OrderedDict([
+    ('report_activity', 'activity_id'),
+    ('report_person', 'person_id'),
+    ('report_day', 'date'),
+])
+
+
+def _report_statements(amount, total='total', by=()):
+    """
+    Builds the statements that create and fill the summary tables and the
+    triggers maintaining them
+    :param amount: name of the event column holding the amount
+    :param total: name of the summary column holding the total
+    :param by: event columns grouped on besides each table's key
+    :return: list of SQL statements
+    """
+    statements = []
+    for table, key in REPORT_TABLES.items():
+        key_type = 'TEXT' if key == 'date' else 'INTEGER'
+        keys = ', '.join((key,) + tuple(by))
+        statements.append(
+            'CREATE TABLE IF NOT EXISTS {0}({1} {2} NOT NULL, {3}'
+            'count INTEGER NOT NULL, {4} NUMERIC NOT NULL, '
+            'PRIMARY KEY ({5})) WITHOUT ROWID'.format(
+                table, key, key_type,
+                ''.join('{} TEXT NOT NULL, '.format(column) for column in by),
+                total, keys))
+        statements.append('DELETE FROM {}'.format(table))
+        statements.append(
+            'INSERT INTO {0}({1}, count, {2}) SELECT {1}, COUNT(*), '
+            'COALESCE(SUM({3}), 0) FROM event WHERE {4} IS NOT NULL '
+            'GROUP BY {1}'.format(
+                table, keys, total, amount, key))
+
+    add = []
+    remove = []
+    for table, key in REPORT_TABLES.items():
+        columns = (key,) + tuple(by)
+        match = ' AND '.join('{0} = OLD.{0}'.format(column)
+                             for column in columns)
+        add.append(
+            'INSERT INTO {0}({1}, count, {2}) '
+            'SELECT {3}, 1, COALESCE(NEW.{4}, 0) WHERE NEW.{5} IS NOT NULL '
+            'ON CONFLICT({1}) DO UPDATE SET count = count + 1, '
+            '{2} = {2} + excluded.{2};'.format(
+                table, ', '.join(columns), total,
+                ', '.join('NEW.' + column for column in columns), amount,
+                key))
+        remove.append(
+            'UPDATE {0} SET count = count - 1, '
+            '{1} = {1} - COALESCE(OLD.{2}, 0) WHERE {3}; '
+            'DELETE FROM {0} WHERE {3} AND count = 0;'.format(
+                table, total, amount, match))
+
+    for operation, body in (('insert', add), ('delete', remove),
+                            ('update', remove + add)):
+        statements.append('DROP TRIGGER IF EXISTS report_event_' + operation)
+        statements.append(
+            'CREATE TRIGGER report_event_{0} AFTER {1} ON event BEGIN {2} '
+            'END'.format(operation, operation.upper(), ' '.join(body)))
+
+    return statements
+
+
+# Tables with a full-text index over their name column, by primary key
+SEARCH_TABLES = OrderedDict([
+    ('person', 'person_id'),
+    ('activity', 'activity_id'),
+])
+
+
+def _search_statements(table, key):
+    """
+    Builds the statements that create and fill an FTS5 index over a table's
+    names and the triggers keeping it in sync. The index stores no copy of
+    the names, only the tokens, and keeps two and three character prefixes
+    so typeahead queries are answered from the index
+    :param table: person or activity
+    :param key: primary key column of the table
+    :return: list of SQL statements
+    """
+    return [
+        'CREATE VIRTUAL TABLE IF NOT EXISTS {0}_fts USING fts5(name, '
+        "content='{0}', content_rowid='{1}', "
+        "tokenize='unicode61 remove_diacritics 2', prefix='2 3')".format(
+            table, key),
+        "INSERT INTO {0}_fts({0}_fts) VALUES('rebuild')".format(table),
+        'CREATE TRIGGER IF NOT EXISTS {0}_fts_insert AFTER INSERT ON {0} '
+        'BEGIN INSERT INTO {0}_fts(rowid, name) VALUES(NEW.{1}, NEW.name); '
+        'END'.format(table, key),
+        'CREATE TRIGGER IF NOT EXISTS {0}_fts_delete AFTER DELETE ON {0} '
+        "BEGIN INSERT INTO {0}_fts({0}_fts, rowid, name) "
+        "VALUES('delete', OLD.{1}, OLD.name); END".format(table, key),
+        'CREATE TRIGGER IF NOT EXISTS {0}_fts_update AFTER UPDATE ON {0} '
+        "BEGIN INSERT INTO {0}_fts({0}_fts, rowid, name) "
+        "VALUES('delete', OLD.{1}, OLD.name); "
+        'INSERT INTO {0}_fts(rowid, name) VALUES(NEW.{1}, NEW.name); '
+        'END'.format(table, key),
+    ]
+
+
+def search_query(text):
+    """
+    Builds an FTS5 query matching names that contain a word starting with
+    each word of the search text. Words are quoted, so FTS5 operators typed
+    by users are searched for literally
+    :param text: search text, e.g. what has been typed so far
+    :return: the query, or None if the text has no words
+    """
+    words = re.findall(r'\w+', text or '')
+    if not words:
+        return None
+    return ' '.join('"{}"*'.format(word) for word in words)
+
+
+# Schema upgrades applied in order by BookingDB.migrate(). Each entry is a list
+# of SQL statements or of functions taking a cursor; the number of entries
+# applied so far is kept in PRAGMA user_version so existing database files can
+# be brought up to date.
+MIGRATIONS = [
+    # 1: secondary indexes for event lookups by person and activity. The
+    # composite indexes also serve lookups on their first column alone.
+    # Lookups by date use the slot index, see BookingDB._create_slot_index().
+    [
+        'CREATE INDEX IF NOT EXISTS idx_event_person_date '
+        'ON event(person_id, date)',
+        'CREATE INDEX IF NOT EXISTS idx_event_activity_date '
+        'ON event(activity_id, date)',
+    ],
+    # 2: one row per person and activity name, so imports can upsert by name
+    _dedupe_names('person', 'person_id') +
+    _dedupe_names('activity', 'activity_id'),
+    # 3: ISO-8601 event dates
+    [_normalize_event_dates],
+    # 4: per-table version counters kept up to date by triggers, so every
+    # process sharing the file sees the same versions. create_tables() keeps
+    # this table, and re-running this step bumps every version, so versions
+    # never repeat for the same file.
+    [
+        'CREATE TABLE IF NOT EXISTS table_version(name TEXT PRIMARY KEY, '
+        'version INTEGER NOT NULL, modified INTEGER NOT NULL) WITHOUT ROWID',
+    ] + [
+        "INSERT OR IGNORE INTO table_version VALUES('{}', 0, 0)".format(table)
+        for table in VERSIONED_TABLES
+    ] + [
+        'UPDATE table_version SET version = version + 1, '
+        "modified = CAST(strftime('%s', 'now') AS INTEGER)",
+    ] + [
+        statement for table in VERSIONED_TABLES
+        for statement in _version_triggers(table)
+    ],
+    # 5: summary tables for the reports
+    _report_statements('amount'),
+    # 6: amounts as integer cents with a currency, so sums are exact. The
+    # report triggers read the old column and are dropped before it is;
+    # the summary tables are then rebuilt with totals in cents.
+    [
+        'ALTER TABLE event ADD COLUMN amount_cents INTEGER',
+        "ALTER TABLE event ADD COLUMN currency TEXT NOT NULL DEFAULT 'USD'",
+        'UPDATE event SET amount_cents = CAST(ROUND(amount * 100) AS INTEGER)',
+    ] + [
+        'DROP TRIGGER IF EXISTS report_event_' + operation
+        for operation in ('insert', 'delete', 'update')
+    ] + [
+        'ALTER TABLE event DROP COLUMN amount',
+    ] + [
+        'DROP TABLE IF EXISTS ' + table for table in REPORT_TABLES
+    ] + _report_statements('amount_cents', 'total_cents', ('currency',)),
+    # 7: full-text indexes for searching people and activities by name
+    [
+        statement for table, key in SEARCH_TABLES.items()
+        for statement in _search_statements(table, key)
+    ],
+    # 8: per-event version, bumped by every update, for optimistic
+    # concurrency control
+    [
+        'ALTER TABLE event ADD COLUMN version INTEGER NOT NULL DEFAULT 1',
+    ],
+]
+
+# Columns selected for events. amount is derived from the stored cents so
+# existing clients keep receiving the amount in currency units.
+EVENT_COLUMNS = '''event.event_id, event.person_id, event.activity_id,
+    event.date, event.amount_cents / 100.0 AS amount, event.amount_cents,
+    event.currency, event.version'''
+
+# Events with the names of their person and activity, so clients showing an
+# event need no further lookups
+EVENT_DETAIL_SELECT = 'SELECT ' + EVENT_COLUMNS + ''',
+    person.name AS person, activity.name AS activity FROM event
+    LEFT JOIN person ON person.person_id = event.person_id
+    LEFT JOIN activity ON activity.activity_id = event.activity_id'''
+
+# Select lists by table, for the queries shared between tables
+TABLE_COLUMNS = {
+    'person': '*',
+    'activity': '*',
+    'event': EVENT_COLUMNS,
+}
+
+OVERVIEW_SELECT = '''
+    SELECT event.event_id as id, person.name as person,
+    activity.name as activity, event.date as date,
+    event.amount_cents / 100.0 as amount FROM event
+    JOIN person ON event.person_id = person.person_id
+    JOIN activity ON event.activity_id = activity.activity_id
+'''
+
+OVERVIEW_QUERY = OVERVIEW_SELECT + '    ORDER BY event.event_id\n'
+
+# Listings served a page at a time by BookingDB.get_listing_page(). Each has
+# the query selecting its rows, its primary key, and the columns it can be
+# sorted by, each as (SQL column, name of the column in the rows). Every sort
+# column is indexed together with the primary key, which breaks ties, so
+# every page is read straight from an index.
+LISTINGS = {
+    'overview': (OVERVIEW_SELECT, ('event.event_id', 'id'), {
+        'id': ('event.event_id', 'id'),
+        'date': ('event.date', 'date'),
+    }),
+    'person': ('SELECT * FROM person', ('person_id', 'person_id'), {
+        'id': ('person_id', 'person_id'),
+        'name': ('name', 'name'),
+    }),
+    'activity': ('SELECT * FROM activity', ('activity_id', 'activity_id'), {
+        'id': ('activity_id', 'activity_id'),
+        'name': ('name', 'name'),
+    }),
+}
+
+# Maximum number of parameters bound into one IN (...) list, well below
+# SQLite's SQLITE_MAX_VARIABLE_NUMBER on older builds.
+SQL_IN_CHUNK = 500
+
+# Columns of the unique index that stops two events being booked into the
+# same slot, by conflict scope. With 'date' only one event can be booked per
+# day; with 'activity' each activity can be booked once per day.
+CONFLICT_SCOPES = {
+    'date': ('date',),
+    'activity': ('activity_id', 'date'),
+}
+
+
+class BookingConflict(Exception):
+    """
+    Raised when an event would be booked into a slot that is already taken
+    """
+
+
+class VersionConflict(Exception):
+    """
+    Raised when an event has changed since the version an update was based
+    on was read
+    """
+    def __init__(self, version):
+        Exception.__init__(self, 'event was modified, now at version {}'
+                           .format(version))
+        self.version = version
+
+
+class StillReferenced(Exception):
+    """
+    Raised when deleting a person or activity that events still refer to
+    """
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no pooled connection becomes free within the pool timeout
+    """
+
+
+class QueryProfiler:
+    """
+    Records how many times each SQL statement ran and how long it took, both
+    in total and for the current thread since begin() was called, and logs
+    statements slower than a threshold.
+    """
+    def __init__(self, slow_query_ms=None, trace=False):
+        """
+        Initializes the profiler
+        :param slow_query_ms: statements taking longer than this are logged
+        as warnings, None to disable
+        :param trace: log every statement SQLite runs, including those run
+        by triggers, at DEBUG level through the sqlite3 trace callback
+        """
+        self.slow_query_ms = slow_query_ms
+        self.trace = trace
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def begin(self):
+        """
+        Starts counting the current thread's queries from zero
+        """
+        self._local.count = 0
+        self._local.seconds = 0.0
+
+    def end(self):
+        """
+        Returns what the current thread ran since begin()
+        :return: (number of statements, seconds spent in SQLite)
+        """
+        return (getattr(self._local, 'count', 0),
+                getattr(self._local, 'seconds', 0.0))
+
+    def record(self, sql, seconds, executions=1):
+        """
+        Adds the time spent on one statement
+        :param sql: the statement
+        :param seconds: time spent executing it or fetching its rows
+        :param executions: 1 for an execution, 0 for fetching more rows of
+        an execution already recorded
+        """
+        self._local.count = getattr(self._local, 'count', 0) + executions
+        self._local.seconds = getattr(self._local, 'seconds', 0.0) + seconds
+        with self._lock:
+            stat = self._stats.get(sql)
+            if stat is None:
+                stat = self._stats[sql] = [0, 0.0]
+            stat[0] += executions
+            stat[1] += seconds
+
+        if self.slow_query_ms is not None and \
+                seconds * 1000 > self.slow_query_ms:
+            logger.warning('slow query (%.1f ms): %s', seconds * 1000,
+                           ' '.join(sql.split()))
+
+    def trace_statement(self, statement):
+        """
+        sqlite3 trace callback logging each statement SQLite runs
+        :param statement: the expanded statement
+        """
+        logger.debug('sql: %s', statement)
+
+    def stats(self):
+        """
+        Returns the totals for every statement seen so far
+        :return: dict mapping each statement to its count and total_ms
+        """
+        with self._lock:
+            return {sql: {'count': stat[0], 'total_ms': stat[1] * 1000}
+                    for sql, stat in self._stats.items()}
+
+
+class ProfilingCursor(sqlite3.Cursor):
+    """
+    Cursor reporting the time spent executing statements and fetching their
+    rows to the QueryProfiler of its connection
+    """
+    def execute(self, sql, parameters=()):
+        self._sql = sql
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.connection.profiler.record(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._sql = sql
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.connection.profiler.record(sql, time.perf_counter() - start)
+
+    def _fetch(self, fetch, *args):
+        start = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            self.connection.profiler.record(
+                self._sql, time.perf_counter() - start, executions=0)
+
+    def fetchone(self):
+        return self._fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        if size is None:
+            return self._fetch(super().fetchmany)
+        return self._fetch(super().fetchmany, size)
+
+    def fetchall(self):
+        return self._fetch(super().fetchall)
+
+
+class ProfilingConnection(sqlite3.Connection):
+    """
+    Connection whose cursors are ProfilingCursors
+    """
+    profiler = None
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or ProfilingCursor)
+
+
+class ConnectionPool:
+    """
+    Keeps a bounded set of sqlite3 connections to one database file. A thread
+    checks a connection out for the duration of one operation and returns it
+    afterwards, so connections are reused across requests and threads but are
+    never used by two threads at the same time.
+    """
+    def __init__(self, filename, size=5, timeout=None, pragmas=None,
+                 profiler=None):
+        """
+        Initializes the pool. Connections are opened lazily on first use
+        :param filename: name of the database file
+        :param size: maximum number of open connections
+        :param timeout: seconds to wait for a free connection, None to wait
+        forever
+        :param pragmas: mapping of PRAGMA names to values applied to each new
+        connection
+        :param profiler: QueryProfiler to report queries to, None to open
+        plain connections
+        """
+        self.filename = filename
+        self.size = size
+        self.pragmas = OrderedDict(pragmas or ())
+        self.profiler = profiler
+        self._timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._local = threading.local()
+        self._counts_lock = threading.Lock()
+        self._open = 0
+        self._in_use = 0
+
+    def _connect(self):
+        """
+        Opens a new connection. check_same_thread is disabled because a
+        connection may be handed to a different thread after it is returned
+        :return: the connection
+        """
+        if self.profiler is None:
+            conn = sqlite3.connect(self.filename, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.filename, check_same_thread=False,
+                                   factory=ProfilingConnection)
+            conn.profiler = self.profiler
+            if self.profiler.trace:
+                conn.set_trace_callback(self.profiler.trace_statement)
+        conn.row_factory = sqlite3.Row
+        for name, value in self.pragmas.items():
+            if not name.isidentifier():
+                raise ValueError('invalid PRAGMA name: ' + repr(name))
+            conn.execute('PRAGMA {} = {}'.format(name, value))
+        return conn
+
+    def acquire(self):
+        """
+        Checks a connection out of the pool, opening one if none are idle
+        :return: the connection
+        """
+        if not self._slots.acquire(timeout=self._timeout):
+            raise PoolTimeout('no free connection to ' + self.filename)
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            try:
+                conn = self._connect()
+            except Exception:
+                self._slots.release()
+                raise
+            with self._counts_lock:
+                self._open += 1
+
+        with self._counts_lock:
+            self._in_use += 1
+        return conn
+
+    def release(self, conn):
+        """
+        Returns a connection to the pool, rolling back anything left
+        uncommitted by the caller
+        :param conn: connection obtained from acquire()
+        """
+        if conn.in_transaction:
+            conn.rollback()
+        with self._counts_lock:
+            self._in_use -= 1
+        self._idle.put(conn)
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager around acquire()/release(). Nested use from the same
+        thread reuses the connection that thread already holds.
+        """
+        held = getattr(self._local, 'conn', None)
+        if held is not None:
+            yield held
+            return
+
+        conn = self.acquire()
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            self.release(conn)
+
+    def close(self):
+        """
+        Closes every idle connection in the pool
+        """
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._counts_lock:
+                self._open -= 1
+
+    def stats(self):
+        """
+        Returns the pool's usage counters
+        :return: dict with size, open and in_use connection counts
+        """
+        with self._counts_lock:
+            return {'size': self.size, 'open': self._open,
+                    'in_use': self._in_use}
+
+
+class WriteQueue:
+    """
+    Funnels writes through one writer thread with its own connection. The
+    writer takes every write queued within a short window, up to a maximum
+    batch size, and commits them together, so a burst of writes shares one
+    transaction and one sync instead of contending for the write lock. Each
+    write runs inside its own savepoint, so a failing write is rolled back
+    and reported on its own without affecting the rest of the batch.
+    """
+    def __init__(self, pool, interval=0.002, max_batch=256):
+        """
+        Initializes the queue and starts the writer thread
+        :param pool: ConnectionPool whose settings the writer's connection
+        uses
+        :param interval: seconds the writer waits for more writes after the
+        first of a batch, 0 to only take the writes already queued
+        :param max_batch: maximum number of writes committed together
+        """
+        self.interval = interval
+        self.max_batch = max_batch
+        self._pool = pool
+        self._queue = queue.Queue()
+        self._counts_lock = threading.Lock()
+        self._batches = 0
+        self._writes = 0
+        self._thread = threading.Thread(target=self._run,
+                                        name='booking-db-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, operation):
+        """
+        Queues a write
+        :param operation: function taking a cursor, run inside the writer's
+        transaction
+        :return: concurrent.futures.Future resolved with the operation's
+        result, or its exception, once the batch is committed
+        """
+        future = concurrent.futures.Future()
+        self._queue.put((operation, future))
+        return future
+
+    def _next_batch(self):
+        """
+        Waits for a write and collects the ones following it
+        :return: list of (operation, future) pairs, and whether the queue was
+        closed
+        """
+        first = self._queue.get()
+        if first is None:
+            return [], True
+
+        batch = [first]
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.max_batch:
+            try:
+                if self.interval:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    item = self._queue.get(timeout=timeout)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+
+        return batch, False
+
+    def _commit(self, conn, batch):
+        """
+        Runs a batch of writes in one transaction and resolves their futures
+        after the commit
+        :param conn: the writer's connection
+        :param batch: list of (operation, future) pairs
+        """
+        results = []
+        try:
+            cur = conn.cursor()
+            cur.execute('BEGIN IMMEDIATE')
+            for operation, _ in batch:
+                cur.execute('SAVEPOINT write')
+                try:
+                    results.append((operation(cur), None))
+                except Exception as e:
+                    cur.execute('ROLLBACK TO write')
+                    results.append((None, e))
+                cur.execute('RELEASE write')
+            conn.commit()
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        with self._counts_lock:
+            self._batches += 1
+            self._writes += len(batch)
+        for (_, future), (result, error) in zip(batch, results):
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def _run(self):
+        """
+        Writer thread: commits batches until the queue is closed
+        """
+        conn = self._pool._connect()
+        try:
+            closed = False
+            while not closed:
+                batch, closed = self._next_batch()
+                if batch:
+                    self._commit(conn, batch)
+        finally:
+            conn.close()
+
+    def close(self):
+        """
+        Commits the writes already queued and stops the writer thread
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+    def stats(self):
+        """
+        Returns the writer's counters
+        :return: dict with the number of committed batches and writes, and
+        of writes waiting in the queue
+        """
+        with self._counts_lock:
+            return {'batches': self._batches, 'writes': self._writes,
+                    'queued': self._queue.qsize()}
+
+
+class LRUCache:
+    """
+    Thread-safe cache of query results bounded by entry count and age. Every
+    entry is tagged with the tables it was read from, so a write to a table
+    drops exactly the entries that depend on it.
+    """
+    def __init__(self, maxsize=256, ttl=30.0, clock=time.monotonic):
+        """
+        Initializes the cache
+        :param maxsize: maximum number of entries kept
+        :param ttl: seconds an entry stays valid
+        :param clock: function returning the current time in seconds
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Looks up a key, refreshing its position in the LRU order
+        :param key: cache key
+        :return: (hit, value) where value is None on a miss
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > self._clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[2]
+
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def generation(self, tags):
+        """
+        Returns the current invalidation generation of some tags. Passing it
+        to put() stops a value read before a concurrent write from being
+        cached after that write invalidated the tags
+        :param tags: table names
+        :return: tuple of generations
+        """
+        with self._lock:
+            return tuple(self._generations.get(tag, 0) for tag in tags)
+
+    def put(self, key, value, tags, generation):
+        """
+        Stores a value unless one of its tags was invalidated since
+        generation was taken
+        :param key: cache key
+        :param value: value to store
+        :param tags: table names the value was read from
+        :param generation: result of generation(tags) before the read
+        """
+        with self._lock:
+            if generation != tuple(self._generations.get(tag, 0)
+                                   for tag in tags):
+                return
+
+            self._entries[key] = (self._clock() + self.ttl, frozenset(tags),
+                                  value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, tags):
+        """
+        Drops every entry tagged with any of the given tags
+        :param tags: table names that were written to
+        """
+        tags = frozenset(tags)
+        with self._lock:
+            for tag in tags:
+                self._generations[tag] = self._generations.get(tag, 0) + 1
+            stale = [key for key, entry in self._entries.items()
+                     if entry[1] & tags]
+            for key in stale:
+                del self._entries[key]
+
+    def clear(self):
+        """
+        Drops every entry
+        """
+        with self._lock:
+            tags = set(self._generations)
+            for entry in self._entries.values():
+                tags |= entry[1]
+            self._entries.clear()
+        self.invalidate(tags)
+
+    def info(self):
+        """
+        Returns the cache counters
+        :return: dict with hits, misses, size and maxsize
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+def _cached(*tables):
+    """
+    Decorates a BookingDB read method so its results are kept in the
+    BookingDB's cache, keyed by the method name, the arguments, keyword
+    arguments sorted by name, and the versions of the tables. The versions
+    make a result read before any write, from this process or another, miss
+    once that write is committed. Cached results are shared between callers
+    and must not be modified
+    :param tables: tables the method reads
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self._cache is None:
+                return method(self, *args, **kwargs)
+
+            versions = self.table_versions(*tables)
+            key = (method.__name__,) + args + \
+                tuple(versions.get(table) for table in tables)
+            if kwargs:
+                key += (tuple(sorted(kwargs.items())),)
+            hit, value = self._cache.get(key)
+            if hit:
+                return value
+
+            generation = self._cache.generation(tables)
+            value = method(self, *args, **kwargs)
+            self._cache.put(key, value, tables, generation)
+            return value
+        return wrapper
+    return decorator
+
+
+def _invalidates(*tables):
+    """
+    Decorates a BookingDB write method so cached reads of the tables it
+    writes are dropped once it finishes
+    :param tables: tables the method writes
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                if self._cache is not None:
+                    self._cache.invalidate(tables)
+        return wrapper
+    return decorator
 
 
 class BookingDB:
     """
     Provides an interface for interacting with the database
     """
-    def __init__(self, filename):
+    def __init__(self, filename, pool_size=5, pool_timeout=None,
+                 pragmas=None, conflict_scope='date', cache_size=256,
+                 cache_ttl=30.0, profile=False, slow_query_ms=None,
+                 trace_sql=False, group_commit=False, group_commit_ms=2.0,
+                 group_commit_rows=256, on_delete='restrict'):
         """
         Initializes the database. Creates the tables if the file doesn't exist
         :param filename: name of the file
+        :param pool_size: maximum number of pooled connections
+        :param pool_timeout: seconds to wait for a pooled connection before
+        raising PoolTimeout, None to wait forever
+        :param pragmas: PRAGMA profile for each connection, DEFAULT_PRAGMAS if
+        None. foreign_keys is turned on unless the profile sets it
+        :param conflict_scope: key of CONFLICT_SCOPES deciding which events
+        count as double bookings
+        :param cache_size: maximum number of cached read results, 0 to
+        disable the read cache
+        :param cache_ttl: seconds a cached read result stays valid
+        :param profile: record per-statement counts and durations in
+        self.profiler
+        :param slow_query_ms: with profile, log statements slower than this
+        :param trace_sql: with profile, log every statement at DEBUG level
+        :param group_commit: send single event inserts and deletes through a
+        WriteQueue that commits them in batches
+        :param group_commit_ms: with group_commit, milliseconds the writer
+        waits to fill a batch
+        :param group_commit_rows: with group_commit, maximum writes per batch
+        :param on_delete: what deleting a person or activity with events
+        does by default: 'restrict' refuses, 'cascade' deletes the events too
+        """
+        if pragmas is None:
+            pragmas = DEFAULT_PRAGMAS
+        pragmas = OrderedDict(pragmas)
+        pragmas.setdefault('foreign_keys', 'ON')
+        if conflict_scope not in CONFLICT_SCOPES:
+            raise ValueError('unknown conflict scope: ' + repr(conflict_scope))
+        self._slot_columns = CONFLICT_SCOPES[conflict_scope]
+        if on_delete not in ('restrict', 'cascade'):
+            raise ValueError('unknown on_delete: ' + repr(on_delete))
+        self._on_delete = on_delete
+        self._cache = LRUCache(cache_size, cache_ttl) if cache_size else None
+        self.profiler = None
+        if profile:
+            self.profiler = QueryProfiler(slow_query_ms, trace_sql)
+        self._pool = ConnectionPool(filename, pool_size, pool_timeout,
+                                    pragmas=pragmas, profiler=self.profiler)
+        self._writer = None
+        if group_commit:
+            self._writer = WriteQueue(self._pool, group_commit_ms / 1000.0,
+                                      group_commit_rows)
+        # Connection watching for commits, and the table versions it last
+        # read, see table_versions()
+        self._watcher = None
+        self._data_version = None
+        self._versions = {}
+        self._versions_lock = threading.Lock()
+
+    def close(self):
+        """
+        Commits any queued writes and closes the connections
+        """
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        with self._versions_lock:
+            if self._watcher is not None:
+                self._watcher.close()
+                self._watcher = None
+                self._data_version = None
+        self._pool.close()
+
+    def write_stats(self):
+        """
+        Returns the group commit writer's counters
+        :return: dict with batches, writes and queued counts, or None if
+        group commit is disabled
+        """
+        if self._writer is None:
+            return None
+        return self._writer.stats()
+
+    def _write(self, operation):
+        """
+        Runs a write and commits it, through the group commit writer when it
+        is enabled. Either way the write is committed when this returns, and
+        the write lock is taken before the operation starts, so a writer in
+        another process makes it wait for busy_timeout rather than fail
+        :param operation: function taking a cursor
+        :return: the operation's result
+        """
+        if self._writer is not None:
+            return self._writer.submit(operation).result()
+
+        with self._pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute('BEGIN IMMEDIATE')
+            result = operation(cur)
+            conn.commit()
+
+            return result
+
+    def pool_stats(self):
         """
-        self._conn = sqlite3.connect(filename)
-        self._conn.row_factory = sqlite3.Row
-        print('BookingDB is called.')
+        Returns the connection pool's usage counters
+        :return: dict with size, open and in_use connection counts
+        """
+        return self._pool.stats()
+
+    def cache_info(self):
+        """
+        Returns the read cache counters
+        :return: dict with hits, misses, size and maxsize, or None if the
+        cache is disabled
+        """
+        if self._cache is None:
+            return None
+        return self._cache.info()
 
+    @_invalidates('person', 'activity', 'event')
     def create_tables(self):
         """
         Creates all of the tables in the database
         """
+        with self._pool.connection() as conn:
+            cur = conn.cursor()
 
-        cur = self._conn.cursor()
-
-        cur.execute('DROP TABLE IF EXISTS person')
-        cur.execute('DROP TABLE IF EXISTS activity')
-        cur.execute('DROP TABLE IF EXISTS event')
-        cur.execute('CREATE TABLE person(person_id INTEGER PRIMARY KEY, name '
-                    'TEXT)')
-        cur.execute('CREATE TABLE activity(activity_id INTEGER PRIMARY KEY, '
-                    'name TEXT)')
-        cur.execute('CREATE TABLE event(event_id INTEGER PRIMARY KEY, '
-                    'person_id INTEGER, activity_id INTEGER, date TEXT, '
-                    'amount FLOAT, '
-                    'FOREIGN KEY (person_id) REFERENCES person(person_id), '
-                    'FOREIGN KEY (activity_id) REFERENCES '
-                    'activity(activity_id))')
-        self._conn.commit()
-        print('Schema is called.')
+            for table in REPORT_TABLES:
+                cur.execute('DROP TABLE IF EXISTS ' + table)
+            for table in SEARCH_TABLES:
+                cur.execute('DROP TABLE IF EXISTS {}_fts'.format(table))
+            cur.execute('DROP TABLE IF EXISTS event')
+            cur.execute('DROP TABLE IF EXISTS activity')
+            cur.execute('DROP TABLE IF EXISTS person')
+            cur.execute('CREATE TABLE person(person_id INTEGER PRIMARY KEY, '
+                        'name TEXT)')
+            cur.execute('CREATE TABLE activity(activity_id INTEGER PRIMARY '
+                        'KEY, name TEXT)')
+            cur.execute('CREATE TABLE event(event_id INTEGER PRIMARY KEY, '
+                        'person_id INTEGER, activity_id INTEGER, date TEXT, '
+                        'amount FLOAT, '
+                        'FOREIGN KEY (person_id) REFERENCES '
+                        'person(person_id), '
+                        'FOREIGN KEY (activity_id) REFERENCES '
+                        'activity(activity_id))')
+            cur.execute('PRAGMA user_version = 0')
+            conn.commit()
+        self.migrate()
+
+    @_invalidates('person', 'activity', 'event')
+    def migrate(self):
+        """
+        Applies every schema migration the database file has not seen yet.
+        Each migration runs in its own write transaction, so concurrent
+        processes starting up against the same file apply it only once
+        :return: the schema version after migrating
+        """
+        with self._pool.connection() as conn:
+            cur = conn.cursor()
+            while True:
+                cur.execute('BEGIN IMMEDIATE')
+                version = cur.execute('PRAGMA user_version').fetchone()[0]
+                if version >= len(MIGRATIONS):
+                    self._create_slot_index(cur)
+                    conn.commit()
+                    return version
 
+                for statement in MIGRATIONS[version]:
+                    if callable(statement):
+                        statement(cur)
+                    else:
+                        cur.execute(statement)
+                cur.execute('PRAGMA user_version = {}'.format(version + 1))
+                conn.commit()
+
+    def _create_slot_index(self, cur):
+        """
+        Makes the unique ux_event_slot index match the conflict scope,
+        replacing an index built for a different scope. Events already
+        sharing a slot keep the index from being built, and until it is,
+        double bookings are not refused. Lookups by date get idx_event_date
+        only when the slot index does not lead with date
+        :param cur: cursor inside a write transaction
+        """
+        cur.execute("PRAGMA index_info('ux_event_slot')")
+        columns = tuple(row['name'] for row in cur.fetchall())
+        if columns != self._slot_columns:
+            cur.execute('DROP INDEX IF EXISTS ux_event_slot')
+            try:
+                cur.execute('CREATE UNIQUE INDEX ux_event_slot ON event({})'
+                            .format(', '.join(self._slot_columns)))
+            except sqlite3.IntegrityError:
+                clashes = self._double_bookings(cur)
+                raise BookingConflict(
+                    '{} slots hold more than one event, first {} with '
+                    'events {}'.format(len(clashes),
+                                       ', '.join(map(str, clashes[0][0])),
+                                       ', '.join(map(str, clashes[0][1]))))
+
+        if self._slot_columns[0] == 'date':
+            cur.execute('DROP INDEX IF EXISTS idx_event_date')
+        else:
+            cur.execute('CREATE INDEX IF NOT EXISTS idx_event_date '
+                        'ON event(date)')
+
+    def _double_bookings(self, cur):
+        """
+        Finds the slots under the conflict scope holding more than one event
+        :param cur: cursor to query with
+        :return: list of (slot, event_ids) pairs, where slot is the tuple of
+        the slot columns' values, ordered by slot
+        """
+        columns = ', '.join(self._slot_columns)
+        cur.execute('SELECT {0}, event_id FROM event WHERE ({0}) IN '
+                    '(SELECT {0} FROM event GROUP BY {0} '
+                    'HAVING count(*) > 1) ORDER BY {0}, event_id'
+                    .format(columns))
+        clashes = []
+        for row in cur.fetchall():
+            slot = tuple(row)[:-1]
+            if not clashes or clashes[-1][0] != slot:
+                clashes.append((slot, []))
+            clashes[-1][1].append(row['event_id'])
+
+        return clashes
+
+    def double_bookings(self):
+        """
+        Lists the events sharing a slot under the conflict scope, which keep
+        migrate() from creating the index that refuses double bookings
+        :return: list of (slot, event_ids) pairs, where slot is the tuple of
+        the slot columns' values, ordered by slot
+        """
+        with self._pool.connection() as conn:
+            return self._double_bookings(conn.cursor())
+
+    def table_versions(self, *tables):
+        """
+        Gets the version counters of some tables. A table's version changes
+        whenever a row of it is inserted, updated or deleted, by any process.
+        The counters are kept in memory and read again only when PRAGMA
+        data_version on a dedicated connection shows that another connection
+        has committed since. That check reads the WAL index in shared memory,
+        not the database, so while nothing is written no table is read
+        :param tables: names of tables in VERSIONED_TABLES
+        :return: dict mapping each table to (version, modified) where modified
+        is the Unix time of the last change
+        """
+        with self._versions_lock:
+            if self._watcher is None:
+                self._watcher = self._pool._connect()
+            # Read before the counters, so a commit landing in between makes
+            # the next call read them again
+            cur = self._watcher.cursor()
+            data_version = cur.execute('PRAGMA data_version').fetchone()[0]
+            if data_version != self._data_version:
+                cur.execute('SELECT name, version, modified '
+                            'FROM table_version')
+                self._versions = {row[0]: (row[1], row[2])
+                                  for row in cur.fetchall()}
+                self._data_version = data_version
+
+            return {table: self._versions[table] for table in tables
+                    if table in self._versions}
+
+    def query_plan(self, query, params=()):
+        """
+        Returns the EXPLAIN QUERY PLAN details for a query
+        :param query: SQL query to explain
+        :param params: parameters of the query
+        :return: list of plan detail strings
+        """
+        with self._pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute('EXPLAIN QUERY PLAN ' + query, params)
+
+            return [row['detail'] for row in cur.fetchall()]
+
+    @_cached('event', 'person', 'activity')
     def overview(self):
         """
          Returns a list of overviews
          :return: list of pverviews
          """
-        cur = self._conn.cursor()
-        query = '''
-            SELECT event.event_id as id, person.name as person, 
-            activity.name as activity, event.date as date, 
-            event.amount as amount FROM event, activity, person
-            WHERE event.person_id = person.person_id
-            AND event.activity_id = activity.activity_id; 
-        '''
-        cur.execute(query)
-        results = []
-        for row in cur.fetchall():
-            results.append(dict(row))
+        with self._pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(OVERVIEW_QUERY)
+            results = []
+            for row in cur.fetchall():
+                results.append(dict(row))
 
         return results
 
+    def iter_overview(self, batch_size=500):
+        """
+        Yields the overview one row at a time, reading the cursor in batches
+        of batch_size so memory use does not grow with the event table. The
+        pooled connection is held until the generator is exhausted or closed
+        :param batch_size: number of rows fetched from SQLite at a time
+        :return: generator of overview rows
+        """
+        conn = self._pool.acquire()
+        try:
+            cur = conn.cursor()
+            cur.execute(OVERVIEW_QUERY)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(row)
+        finally:
+            self._pool.release(conn)
+
+    @_cached('person')
     def get_all_people(self):
         """
         Returns a list of all elements in the person table
         :return: list of people
         """
-        cur = self._conn.cursor()
-        cur.execute('SELECT * FROM person')
-        people = []
-        for row in cur.fetchall():
-            people.append(dict(row))
+        with self._pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT * FROM person')
+            people = []
+            for row in cur.fetchall():
+                people.append(dict(row))
 
         return people
 
+    @_cached('activity')
     def get_all_activities(self):
         """
         Gets a list of all elements in the activity table
         :return: list of activities
         """
-        cur = self._conn.cursor()
-        cur.execute('SELECT * FROM activity')
-        activities = []
-        for row in cur.fetchall():
-            activities.append(dict(row))
+        with self._pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT * FROM activity')
+            activities = []
+            for row in cur.fetchall():
+                activities.append(dict(row))
 
         return activities
 
+    @_cached('event')
     def get_all_events(self):
         """
         Gets a list of all elements in the event table
         :return: list of events
         """
-        cur = self._conn.cursor()
-        cur.execute('SELECT * FROM event')
-        events = []
-        for row in cur.fetchall():
-            events.append(dict(row))
+        with self._pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT ' + EVENT_COLUMNS + ' FROM event')
+            events = []
+            for row in cur.fetchall():
+                events.append(dict(row))
 
         return events
 
+    @_cached('person', 'activity', 'event')
+    def get_all_rows(self, table):
+        """
+        Gets every row of a table as plain tuples, skipping the per-row dict
+        conversion of the get_all_* methods
+        :param table: name of a table in VERSIONED_TABLES
+        :return: (columns, rows) where columns lists the column names and
+        rows is a list of tuples
+        """
+        if table not in VERSIONED_TABLES:
+            raise ValueError('unknown table: ' + repr(table))
+
+        with self._pool.connection() as conn:
+            cur = conn.cursor()
+            cur.row_factory = None
+            cur.execute('SELECT {} FROM {}'.format(TABLE_COLUMNS[table],
+                                                   table))
+            columns = [column[0] for column in cur.description]
+
+            return columns, cur.fetchall()
+
+    def _get_page(self, table, key, after_id, limit):
+        """
+        Gets one page of a table ordered by its primary key. Keyset paging
+        seeks straight to after_id through the primary key, so every page
+        costs the same no matter how deep into the table it is
+        :param table: name of the table
+        :param key: name of the table's primary key column
+        :param after_id: only rows with a key greater than this are returned
+        :param limit: maximum number of rows to return
+        :return: list of rows
+        """
+        with self._pool.connection() as conn:
+            cur = conn.cursor()
+            query = 'SELECT {0} FROM {1} WHERE {2} > ? ORDER BY {2} LIMIT ?'
+            cur.execute(query.format(TABLE_COLUMNS[table], table, key),
+                        (after_id, limit))
+            rows = []
+            for row in cur.fetchall():
+                rows.append(dict(row))
+
+        return rows
+
+    def get_listing_page(self, listing, sort='id', descending=False,
+                         after=None, limit=100):
+        """
+        Gets one page of a listing sorted on one of its columns. Like
+        _get_page this seeks to the previous page's last row through an
+        index, using the primary key to order rows with equal sort values
+        :param listing: name of a listing in LISTINGS
+        :param sort: name of one of the listing's sort columns
+        :param descending: sort from the highest value down
+        :param after: (sort value, primary key) of the last row of the
+        previous page, None for the first page
+        :param limit: maximum number of rows to return
+        :return: list of rows
+        """
+        if listing not in LISTINGS:
+            raise ValueError('unknown listing: ' + repr(listing))
+        query, key, sorts = LISTINGS[listing]
+        if sort not in sorts:
+            raise ValueError('unknown sort: ' + repr(sort))
+
+        columns = (key[0],)
+        if sorts[sort][0] != key[0]:
+            columns = (sorts[sort][0], key[0])
+        params = []
+        if after is not None:
+            query += ' WHERE ({}) {} ({})'.format(
+                ', '.join(columns), '<' if descending else '>',
+                ', '.join('?' * len(columns)))
+            params.extend(after[-len(columns):])
+        query += ' ORDER BY {} LIMIT ?'.format(', '.join(
+            column + (' DESC' if descending else '') for column in columns))
+        params.append(limit)
+
+        with self._pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(query, params)
+            rows = []
+            for row in cur.fetchall():
+                rows.append(dict(row))
+
+        return rows
+
+    def get_people_page(self, after_id=0, limit=100):
+        """
+        Gets a page of the person table
+        :param after_id: id of the last person on the previous page
+        :param limit: maximum number of people to return
+        :return: list of people
+        """
+        return self._get_page('person', 'person_id', after_id, limit)
+
+    def get_activities_page(self, after_id=0, limit=100):
+        """
+        Gets a page of the activity table
+        :param after_id: id of the last activity on the previous page
+        :param limit: maximum number of activities to return
+        :return: list of activities
+        """
+        return self._get_page('activity', 'activity_id', after_id, limit)
+
+    def get_events_page(self, after_id=0, limit=100):
+        """
+        Gets a page of the event table
+        :param after_id: id of the last event on the previous page
+        :param limit: maximum number of events to return
+        :return: list of events
+        """
+        return self._get_page('event', 'event_id', after_id, limit)
+
+    @_cached('event', 'person', 'activity')
+    def get_report(self, group, date_from=None, date_to=None):
+        """
+        Gets the number of events and their total amount per group and
+        currency, read from the summary tables so the cost depends on the
+        number of groups, not on the number of events. Totals are summed in
+        integer cents, so they are exact
+        :param group: activity, person, day or month
+        :param date_from: first date included, for day and month reports
+        :param date_to: last date included, for day and month reports
+        :return: list of dicts with the group's key, currency, count,
+        total_cents and total
+        """
+        date_from = normalize_date(date_from) if date_from else '0000-00-00'
+        date_to = normalize_date(date_to) if date_to else '9999-99-99'
+        queries = {
+            'activity': '''
+                SELECT report.activity_id, activity.name, report.currency,
+                report.count, report.total_cents,
+                report.total_cents / 100.0 AS total
+                FROM report_activity AS report
+                LEFT JOIN activity USING (activity_id)
+                ORDER BY report.activity_id, report.currency''',
+            'person': '''
+                SELECT report.person_id, person.name, report.currency,
+                report.count, report.total_cents,
+                report.total_cents / 100.0 AS total
+                FROM report_person AS report
+                LEFT JOIN person USING (person_id)
+                ORDER BY report.person_id, report.currency''',
+            'day': '''
+                SELECT date, currency, count, total_cents,
+                total_cents / 100.0 AS total FROM report_day
+                WHERE date BETWEEN :date_from AND :date_to
+                ORDER BY date, currency''',
+            'month': '''
+                SELECT substr(date, 1, 7) AS month, currency,
+                SUM(count) AS count, SUM(total_cents) AS total_cents,
+                SUM(total_cents) / 100.0 AS total FROM report_day
+                WHERE date BETWEEN :date_from AND :date_to
+                GROUP BY month, currency ORDER BY month, currency''',
+        }
+        if group not in queries:
+            raise ValueError('unknown report: ' + repr(group))
+
+        with self._pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(queries[group], {'date_from': date_from,
+                                         'date_to': date_to})
+            rows = []
+            for row in cur.fetchall():
+                rows.append(dict(row))
+
+        return rows
+
+    def load_event_columns(self, date_from=None, date_to=None,
+                           currency=None, batch_size=10000):
+        """
+        Loads the amount, date and activity of every event in a date range
+        into an analytics.EventColumns, for exact and vectorized totals,
+        percentiles and histograms. Rows are read in batches of plain tuples
+        and stored as 64-bit integers, about 24 bytes per event
+        :param date_from: first date included, None for no lower bound
+        :param date_to: last date included, None for no upper bound
+        :param currency: ISO 4217 code of the events, DEFAULT_CURRENCY if None
+        :param batch_size: number of rows fetched from SQLite at a time
+        :return: analytics.EventColumns
+        """
+        date_from = normalize_date(date_from) if date_from else '0000-00-00'
+        date_to = normalize_date(date_to) if date_to else '9999-99-99'
+        columns = analytics.EventColumns()
+
+        with self._pool.connection() as conn:
+            cur = conn.cursor()
+            cur.row_factory = None
+            query = '''SELECT amount_cents,
+                       CAST(julianday(date) - julianday('1970-01-01')
+                       AS INTEGER), activity_id FROM event
+                       WHERE date BETWEEN ? AND ? AND currency = ?
+                       AND amount_cents IS NOT NULL
+                       AND julianday(date) IS NOT NULL
+                       AND activity_id IS NOT NULL'''
+            cur.execute(query, (date_from, date_to,
+                                normalize_currency(currency)))
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                columns.extend(rows)
+
+        return columns
+
+    def _search(self, table, key, text, limit):
+        """
+        Finds the rows of a table whose name matches a search, best matches
+        first, through the table's full-text index
+        :param table: person or activity
+        :param key: primary key column of the table
+        :param text: search text, see search_query()
+        :param limit: maximum number of rows to return
+        :return: list of rows
+        """
+        query = search_query(text)
+        if query is None:
+            return []
+
+        with self._pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT {0}.* FROM {0}_fts JOIN {0} '
+                        'ON {0}.{1} = {0}_fts.rowid '
+                        'WHERE {0}_fts MATCH ? '
+                        'ORDER BY {0}_fts.rank, {0}.name '
+                        'LIMIT ?'.format(table, key), (query, limit))
+            rows = []
+            for row in cur.fetchall():
+                rows.append(dict(row))
+
+        return rows
+
+    @_cached('person')
+    def search_people(self, text, limit=10):
+        """
+        Finds people by name for typeahead. Each word typed matches names
+        with a word starting with it, in any order
+        :param text: search text
+        :param limit: maximum number of people to return
+        :return: list of people, best matches first
+        """
+        return self._search('person', 'person_id', text, limit)
+
+    @_cached('activity')
+    def search_activities(self, text, limit=10):
+        """
+        Finds activities by name for typeahead. Each word typed matches names
+        with a word starting with it, in any order
+        :param text: search text
+        :param limit: maximum number of activities to return
+        :return: list of activities, best matches first
+        """
+        return self._search('activity', 'activity_id', text, limit)
+
+    @_cached('person')
     def get_person_by_id(self, person_id):
         """
         Gets a person from the person table by id
         :param person_id: id of the person
-        :return: person associated with id
+        :return: person associated with id, or None if there is none
         """
-        cur = self._conn.cursor()
-        query = '''SELECT * FROM person WHERE person.person_id = ?'''
-        cur.execute(query, (person_id,))
+        with self._pool.connection() as conn:
+            cur = conn.cursor()
+            query = '''SELECT * FROM person WHERE person.person_id = ?'''
+            cur.execute(query, (person_id,))
+            row = cur.fetchone()
 
-        return dict(cur.fetchone())
+            return dict(row) if row is not None else None
 
+    @_cached('activity')
     def get_activity_by_id(self, activity_id):
         """
         Gets an activity from the activity table by id
         :param activity_id: id of the person
-        :return: acitivity associated with id
+        :return: acitivity associated with id, or None if there is none
         """
-        cur = self._conn.cursor()
-        query = '''SELECT * FROM activity WHERE activity.activity_id = ?'''
-        cur.execute(query, (activity_id,))
+        with self._pool.connection() as conn:
+            cur = conn.cursor()
+            query = '''SELECT * FROM activity WHERE activity.activity_id = ?'''
+            cur.execute(query, (activity_id,))
+            row = cur.fetchone()
 
-        return dict(cur.fetchone())
+            return dict(row) if row is not None else None
 
+    @_cached('event', 'person', 'activity')
     def get_event_by_id(self, event_id):
         """
-        Gets an event from the event table by id
+        Gets an event from the event table by id, along with the names of its
+        person and activity
         :param event_id: id of the event
-        :return: event associated with id
+        :return: event associated with id, or None if there is none
         """
-        cur = self._conn.cursor()
-        query = '''SELECT * FROM event WHERE event.event_id = ?'''
-        cur.execute(query, (event_id,))
+        with self._pool.connection() as conn:
+            cur = conn.cursor()
+            query = EVENT_DETAIL_SELECT + ' WHERE event.event_id = ?'
+            cur.execute(query, (event_id,))
+            row = cur.fetchone()
 
-        return dict(cur.fetchone())
+            return dict(row) if row is not None else None
+
+    def _get_by_ids(self, select, key, ids):
+        """
+        Gets the rows with the given primary keys, with one IN (...) query
+        per SQL_IN_CHUNK ids
+        :param select: query selecting the rows, without a WHERE clause
+        :param key: (SQL column, name of the column in the rows) of the
+        primary key
+        :param ids: ids to look up, duplicates allowed
+        :return: list of rows in the order of ids, skipping ids not found
+        """
+        ids = list(OrderedDict.fromkeys(ids))
+        found = {}
+
+        with self._pool.connection() as conn:
+            cur = conn.cursor()
+            for start in range(0, len(ids), SQL_IN_CHUNK):
+                chunk = ids[start:start + SQL_IN_CHUNK]
+                cur.execute('{} WHERE {} IN ({})'.format(
+                    select, key[0], ','.join('?' * len(chunk))), chunk)
+                for row in cur.fetchall():
+                    found[row[key[1]]] = dict(row)
+
+        return [found[id] for id in ids if id in found]
+
+    def get_events_by_ids(self, event_ids):
+        """
+        Gets many events by id in one query, each along with the names of
+        its person and activity
+        :param event_ids: list of event ids
+        :return: list of the events found, in the order of event_ids
+        """
+        return self._get_by_ids(EVENT_DETAIL_SELECT,
+                                ('event.event_id', 'event_id'), event_ids)
+
+    def get_people_by_ids(self, person_ids):
+        """
+        Gets many people by id in one query
+        :param person_ids: list of person ids
+        :return: list of the people found, in the order of person_ids
+        """
+        return self._get_by_ids('SELECT * FROM person',
+                                ('person_id', 'person_id'), person_ids)
+
+    def get_activities_by_ids(self, activity_ids):
+        """
+        Gets many activities by id in one query
+        :param activity_ids: list of activity ids
+        :return: list of the activities found, in the order of activity_ids
+        """
+        return self._get_by_ids('SELECT * FROM activity',
+                                ('activity_id', 'activity_id'), activity_ids)
 
     def get_event_by_person(self, person_id):
         """
@@ -140,12 +1712,14 @@ class BookingDB:
         :param person_id: id of the activity
         :return: list of all events for a person
         """
-        cur = self._conn.cursor()
-        query = '''SELECT * FROM event WHERE event.person_id = ?'''
-        cur.execute(query, (person_id,))
-        events = []
-        for row in cur.fetchall():
-            events.append(dict(row))
+        with self._pool.connection() as conn:
+            cur = conn.cursor()
+            query = 'SELECT ' + EVENT_COLUMNS + \
+                ' FROM event WHERE event.person_id = ?'
+            cur.execute(query, (person_id,))
+            events = []
+            for row in cur.fetchall():
+                events.append(dict(row))
 
         return events
 
@@ -155,90 +1729,463 @@ class BookingDB:
         :param activity_id: id of the activity
         :return: list of all events for an activity
         """
-        cur = self._conn.cursor()
-        query = '''SELECT * FROM event WHERE event.activity_id = ?'''
-        cur.execute(query, (activity_id,))
-        events = []
-        for row in cur.fetchall():
-            events.append(row)
-
+        with self._pool.connection() as conn:
+            cur = conn.cursor()
+            query = 'SELECT ' + EVENT_COLUMNS + \
+                ' FROM event WHERE event.activity_id = ?'
+            cur.execute(query, (activity_id,))
+            events = []
+            for row in cur.fetchall():
+                events.append(dict(row))
 
         return events
 
     def get_event_by_date(self, date):
         """
         Gets all events from the event table by the date its scheduled
-        :param date: id of the activity
+        :param date: date in any of the DATE_FORMATS
         :return: list of all events for a date
         """
-        cur = self._conn.cursor()
-        query = '''SELECT * FROM event WHERE event.date = ?'''
-        cur.execute(query, (date,))
-        events = []
-        for row in cur.fetchall():
-            events.append(row)
+        with self._pool.connection() as conn:
+            cur = conn.cursor()
+            query = 'SELECT ' + EVENT_COLUMNS + \
+                ' FROM event WHERE event.date = ?'
+            cur.execute(query, (normalize_date(date),))
+            events = []
+            for row in cur.fetchall():
+                events.append(dict(row))
+
+        return events
+
+    def get_events_between(self, date_from=None, date_to=None):
+        """
+        Gets all events scheduled within a date range, ordered by date
+        :param date_from: first date of the range, None for no lower bound
+        :param date_to: last date of the range, None for no upper bound
+        :return: list of events
+        """
+        date_from = normalize_date(date_from) if date_from else '0000-00-00'
+        date_to = normalize_date(date_to) if date_to else '9999-99-99'
+
+        with self._pool.connection() as conn:
+            cur = conn.cursor()
+            query = 'SELECT ' + EVENT_COLUMNS + ''' FROM event
+                       WHERE event.date BETWEEN ? AND ?
+                       ORDER BY event.date, event.event_id'''
+            cur.execute(query, (date_from, date_to))
+            events = []
+            for row in cur.fetchall():
+                events.append(dict(row))
 
         return events
 
+    def get_occupancy(self, date_from, date_to):
+        """
+        Counts the events booked on each day of a date range. Only the date
+        index is read
+        :param date_from: first date of the range
+        :param date_to: last date of the range
+        :return: dict mapping ISO dates that have events to their count
+        """
+        with self._pool.connection() as conn:
+            cur = conn.cursor()
+            query = '''SELECT date, COUNT(*) FROM event
+                       WHERE date BETWEEN ? AND ? GROUP BY date'''
+            cur.execute(query, (normalize_date(date_from),
+                                normalize_date(date_to)))
+
+            return {row[0]: row[1] for row in cur.fetchall()}
+
     def insert_person(self, name):
         """
-        Posts a new person into the person table.
+        Posts a new person into the person table, unless a person with that
+        name already exists.
         :param name: name of person
+        :return: id of the person
         """
-        cur = self._conn.cursor()
-        cur.execute('INSERT INTO person(name) VALUES(?)',
-                    (name,))
-        self._conn.commit()
+        return self.import_people([name])[name]
 
     def insert_activity(self, name):
         """
-        Posts a new activity into the activity table
+        Posts a new activity into the activity table, unless an activity with
+        that name already exists
         :param name: name of the activity
+        :return: id of the activity
+        """
+        return self.import_activities([name])[name]
+
+    def _import_names(self, table, key, names):
+        """
+        Upserts names into a table in a single transaction
+        :param table: person or activity
+        :param key: primary key column of the table
+        :param names: names to import, duplicates allowed
+        :return: dict mapping each name to its id
+        """
+        names = list(OrderedDict.fromkeys(names))
+        ids = {}
+
+        with self._pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute('BEGIN IMMEDIATE')
+            cur.executemany('INSERT INTO {}(name) VALUES(?) '
+                            'ON CONFLICT(name) DO NOTHING'.format(table),
+                            [(name,) for name in names])
+            for start in range(0, len(names), SQL_IN_CHUNK):
+                chunk = names[start:start + SQL_IN_CHUNK]
+                query = 'SELECT name, {1} FROM {0} WHERE name IN ({2})'.format(
+                    table, key, ','.join('?' * len(chunk)))
+                cur.execute(query, chunk)
+                ids.update((row[0], row[1]) for row in cur.fetchall())
+            conn.commit()
+
+        return ids
+
+    @_invalidates('person')
+    def import_people(self, names):
+        """
+        Posts many people into the person table in one transaction, reusing
+        the existing person for any name that is already there
+        :param names: list of names
+        :return: dict mapping each name to its person_id
+        """
+        return self._import_names('person', 'person_id', names)
+
+    @_invalidates('activity')
+    def import_activities(self, names):
         """
-        cur = self._conn.cursor()
-        cur.execute('INSERT INTO activity(name) VALUES(?)', (name,))
-        self._conn.commit()
+        Posts many activities into the activity table in one transaction,
+        reusing the existing activity for any name that is already there
+        :param names: list of names
+        :return: dict mapping each name to its activity_id
+        """
+        return self._import_names('activity', 'activity_id', names)
 
-    def insert_event(self, person_id, activity_id, date, amount):
+    @_invalidates('event')
+    def insert_event(self, person_id, activity_id, date, amount,
+                     currency=None):
         """
         Posts a new event into the event table. Currently requires person and
         activity to be in their respective tables
         :param person: person hosting the event
         :param activity: type of activity of the event
-        :param date: date of the event
-        :param amount: amount of money the event costs
+        :param date: date of the event, in any of the DATE_FORMATS
+        :param amount: amount of money the event costs, in currency units
+        :param currency: ISO 4217 code, DEFAULT_CURRENCY if None
+        :return: id of the new event
         """
-        cur = self._conn.cursor()
+        row = (person_id, activity_id, normalize_date(date), to_cents(amount),
+               normalize_currency(currency))
+
+        def insert(cur):
+            try:
+                cur.execute('INSERT INTO event(person_id, activity_id, date, '
+                            'amount_cents, currency) VALUES(?,?,?,?,?)', row)
+            except sqlite3.IntegrityError as e:
+                if 'UNIQUE' in str(e):
+                    raise BookingConflict('date already booked')
+                if 'FOREIGN KEY' in str(e):
+                    raise ValueError('person or activity not found')
+                raise
+
+            return cur.lastrowid
+
+        return self._write(insert)
 
-        cur.execute('INSERT INTO event(person_id, activity_id, date, amount) '
-                    'VALUES(?,?,?,?)',
-                    (person_id, activity_id, date, amount,))
+    @_invalidates('event')
+    def update_event(self, event_id, changes, version=None):
+        """
+        Changes an event with a single UPDATE, which also bumps the event's
+        version. When version is given the UPDATE only matches that version,
+        so an update based on a stale read fails instead of overwriting a
+        newer one, without holding a lock between the read and the write
+        :param event_id: id of the event
+        :param changes: dict with any of person_id, activity_id, date,
+        amount and currency
+        :param version: version the changes were based on, None to update
+        whatever the current version is
+        :return: the updated event, or None if there is no such event
+        """
+        values = OrderedDict()
+        for field, value in changes.items():
+            if field == 'date':
+                values['date'] = normalize_date(value)
+            elif field == 'amount':
+                values['amount_cents'] = to_cents(value)
+            elif field == 'currency':
+                values['currency'] = normalize_currency(value)
+            elif field in ('person_id', 'activity_id'):
+                values[field] = value
+            else:
+                raise ValueError('unknown field: ' + repr(field))
+
+        query = 'UPDATE event SET {}version = version + 1 ' \
+                'WHERE event.event_id = ?'.format(
+                    ''.join(column + ' = ?, ' for column in values))
+        params = list(values.values()) + [event_id]
+        if version is not None:
+            query += ' AND event.version = ?'
+            params.append(version)
+        query += ' RETURNING ' + EVENT_COLUMNS
+
+        def update(cur):
+            try:
+                cur.execute(query, params)
+                row = cur.fetchone()
+            except sqlite3.IntegrityError as e:
+                if 'UNIQUE' in str(e):
+                    raise BookingConflict('date already booked')
+                if 'FOREIGN KEY' in str(e):
+                    raise ValueError('person or activity not found')
+                raise
+            if row is not None:
+                return dict(row)
+
+            cur.execute('SELECT version FROM event WHERE event_id = ?',
+                        (event_id,))
+            current = cur.fetchone()
+            if current is None:
+                return None
+            raise VersionConflict(current[0])
+
+        return self._write(update)
+
+    def _existing_ids(self, cur, table, key, ids):
+        """
+        Returns which of the given ids exist in a table
+        :param cur: cursor to query with
+        :param table: name of the table
+        :param key: name of the table's primary key column
+        :param ids: ids to look up
+        :return: set of the ids that exist
+        """
+        ids = list(set(ids))
+        found = set()
+        for start in range(0, len(ids), SQL_IN_CHUNK):
+            chunk = ids[start:start + SQL_IN_CHUNK]
+            query = 'SELECT {1} FROM {0} WHERE {1} IN ({2})'.format(
+                table, key, ','.join('?' * len(chunk)))
+            cur.execute(query, chunk)
+            found.update(row[0] for row in cur.fetchall())
+
+        return found
+
+    def _slot(self, event):
+        """
+        Returns the slot an event occupies under the conflict scope
+        :param event: (person_id, activity_id, date, amount) tuple
+        :return: tuple of the slot column values
+        """
+        if len(self._slot_columns) == 1:
+            return (event[2],)
+        return (event[1], event[2])
+
+    def _booked_slots(self, cur, events):
+        """
+        Returns the slots already taken on the dates of the given events,
+        looked up through the date index
+        :param cur: cursor to query with
+        :param events: list of (person_id, activity_id, date, amount) tuples
+        :return: set of slots
+        """
+        dates = list(set(event[2] for event in events if event[2]))
+        slots = set()
+        for start in range(0, len(dates), SQL_IN_CHUNK):
+            chunk = dates[start:start + SQL_IN_CHUNK]
+            query = 'SELECT {} FROM event WHERE date IN ({})'.format(
+                ', '.join(self._slot_columns), ','.join('?' * len(chunk)))
+            cur.execute(query, chunk)
+            slots.update(tuple(row) for row in cur.fetchall())
+
+        return slots
+
+    @_invalidates('event')
+    def insert_events(self, events):
+        """
+        Posts many events into the event table in a single transaction, so the
+        whole batch costs one commit. Events whose person or activity does not
+        exist, whose date is invalid or whose slot is already booked, are
+        skipped and reported instead of failing the batch
+        :param events: list of (person_id, activity_id, date, amount) or
+        (person_id, activity_id, date, amount, currency) tuples
+        :return: (ids, errors) where ids lists the new event id for each
+        input event, or None if it was skipped, and errors maps the index of
+        each skipped event to the reason
+        """
+        ids = [None] * len(events)
+        errors = {}
 
-        self._conn.commit()
+        normalized = []
+        for index, event in enumerate(events):
+            try:
+                date = normalize_date(event[2])
+                cents = to_cents(event[3])
+                currency = normalize_currency(
+                    event[4] if len(event) > 4 else None)
+            except (AttributeError, ValueError) as e:
+                errors[index] = str(e)
+                date = cents = currency = None
+            normalized.append((event[0], event[1], date, cents, currency))
+        events = normalized
+
+        with self._pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute('BEGIN IMMEDIATE')
+
+            people = self._existing_ids(cur, 'person', 'person_id',
+                                        [e[0] for e in events])
+            activities = self._existing_ids(cur, 'activity', 'activity_id',
+                                            [e[1] for e in events])
+            booked = self._booked_slots(cur, events)
+            rows = []
+            for index, event in enumerate(events):
+                if index in errors:
+                    continue
+                elif event[0] not in people:
+                    errors[index] = 'person not found'
+                elif event[1] not in activities:
+                    errors[index] = 'activity not found'
+                elif self._slot(event) in booked:
+                    errors[index] = 'date already booked'
+                else:
+                    booked.add(self._slot(event))
+                    rows.append((index, event))
+
+            # The write lock is held from BEGIN IMMEDIATE, and new rowids
+            # are allocated as max(rowid) + 1, so the batch gets consecutive
+            # ids following the current maximum.
+            cur.execute('SELECT COALESCE(MAX(event_id), 0) FROM event')
+            last_id = cur.fetchone()[0]
+            cur.executemany('INSERT INTO event(person_id, activity_id, date, '
+                            'amount_cents, currency) VALUES(?,?,?,?,?)',
+                            [event for _, event in rows])
+            conn.commit()
+
+        for offset, (index, _) in enumerate(rows, 1):
+            ids[index] = last_id + offset
+
+        return ids, errors
+
+    def _delete(self, cur, table, key, ids, returning='*'):
+        """
+        Deletes rows by primary key, one DELETE ... RETURNING statement per
+        SQL_IN_CHUNK ids, so the deleted rows are read without a separate
+        SELECT
+        :param cur: cursor inside the write transaction
+        :param table: name of the table
+        :param key: column matched against the ids
+        :param ids: ids of the rows to delete
+        :param returning: columns of the deleted rows to return
+        :return: list of the deleted rows
+        """
+        ids = list(OrderedDict.fromkeys(ids))
+        rows = []
+        for start in range(0, len(ids), SQL_IN_CHUNK):
+            chunk = ids[start:start + SQL_IN_CHUNK]
+            cur.execute('DELETE FROM {0} WHERE {0}.{1} IN ({2}) '
+                        'RETURNING {3}'.format(table, key,
+                                               ','.join('?' * len(chunk)),
+                                               returning), chunk)
+            rows.extend(dict(row) for row in cur.fetchall())
+
+        return rows
+
+    def _delete_referenced(self, table, key, ids, cascade):
+        """
+        Deletes people or activities in one transaction. Unless cascading,
+        the whole batch is rejected if any event still refers to one of them,
+        by foreign key enforcement or, on connections with it turned off, by
+        looking for such events first
+        :param table: person or activity
+        :param key: primary key column of the table, and the column of event
+        referring to it
+        :param ids: ids of the rows to delete
+        :param cascade: also delete the events referring to the rows, None
+        to use the on_delete setting
+        :return: (rows, event_ids) with the deleted rows and the ids of the
+        events deleted with them
+        """
+        if cascade is None:
+            cascade = self._on_delete == 'cascade'
+        ids = list(ids)
+
+        def delete(cur):
+            events = []
+            if cascade:
+                events = self._delete(cur, 'event', key, ids, 'event_id')
+            elif not cur.execute('PRAGMA foreign_keys').fetchone()[0]:
+                for start in range(0, len(ids), SQL_IN_CHUNK):
+                    chunk = ids[start:start + SQL_IN_CHUNK]
+                    cur.execute('SELECT 1 FROM event WHERE {} IN ({}) LIMIT 1'
+                                .format(key, ','.join('?' * len(chunk))),
+                                chunk)
+                    if cur.fetchone() is not None:
+                        raise StillReferenced(
+                            '{} still has events'.format(table))
+            try:
+                rows = self._delete(cur, table, key, ids)
+            except sqlite3.IntegrityError as e:
+                if 'FOREIGN KEY' not in str(e):
+                    raise
+                raise StillReferenced('{} still has events'.format(table))
+
+            return rows, [event['event_id'] for event in events]
+
+        return self._write(delete)
+
+    @_invalidates('person', 'event')
+    def delete_people(self, person_ids, cascade=None):
+        """
+        Deletes people from the person table in one transaction
+        :param person_ids: ids of the people to delete
+        :param cascade: also delete their events; None to use the on_delete
+        setting. Otherwise StillReferenced is raised if any of them has events
+        :return: (people, event_ids) with the deleted people and the ids of
+        the events deleted with them
+        """
+        return self._delete_referenced('person', 'person_id', person_ids,
+                                       cascade)
+
+    @_invalidates('activity', 'event')
+    def delete_activities(self, activity_ids, cascade=None):
+        """
+        Deletes activities from the activity table in one transaction
+        :param activity_ids: ids of the activities to delete
+        :param cascade: also delete their events; None to use the on_delete
+        setting. Otherwise StillReferenced is raised if any of them has events
+        :return: (activities, event_ids) with the deleted activities and the
+        ids of the events deleted with them
+        """
+        return self._delete_referenced('activity', 'activity_id',
+                                       activity_ids, cascade)
+
+    @_invalidates('event')
+    def delete_events(self, event_ids):
+        """
+        Deletes events from the event table in one transaction
+        :param event_ids: ids of the events to delete
+        :return: list of the deleted events
+        """
+        return self._write(lambda cur: self._delete(
+            cur, 'event', 'event_id', event_ids, EVENT_COLUMNS))
 
     def delete_person(self, person_id):
         """
         Deletes a person from the person table
         :param person_id: id of the person to delete
         """
-        cur = self._conn.cursor()
-        query = '''DELETE FROM person WHERE person.person_id = ?'''
-        cur.execute(query, (person_id,))
+        self.delete_people([person_id])
 
     def delete_activity(self, activity_id):
         """
         Deletes an activity from the activity table
         :param activity_id: id of the person to delete
         """
-        cur = self._conn.cursor()
-        query = '''DELETE FROM activity WHERE activity.activity_id = ?'''
-        cur.execute(query, (activity_id,))
+        self.delete_activities([activity_id])
 
     def delete_event(self, event_id):
         """
         Deletes an event from the event table
         :param event_id: id of the event to delete
         """
-        cur = self._conn.cursor()
-        query = '''DELETE FROM event WHERE event.event_id = ?'''
-        cur.execute(query, (event_id,))
+        self.delete_events([event_id])
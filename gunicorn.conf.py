@@ -0,0 +1,35 @@
+"""
+Prefork deployment: one worker process per core, each serving requests on a
+few threads, all on the same SQLite file.
+
+    gunicorn -c gunicorn.conf.py
+
+The app is loaded once, before forking, but opens no database until it is
+used, so every worker opens its own pooled read connections, read cache and
+fragment cache after the fork. Writes from different workers are serialized
+by SQLite: the database runs in WAL mode, so readers never wait for them, and
+each write takes the write lock up front under busy_timeout, so a worker that
+finds another one writing waits rather than fails. Each worker's read cache
+is keyed by the table versions, which every process's writes bump.
+
+Run `flask --app main_api initdb` or `migratedb` before starting the workers.
+"""
+import multiprocessing
+
+import main_api
+
+
+wsgi_app = 'main_api:create_app()'
+bind = '0.0.0.0:8000'
+workers = multiprocessing.cpu_count()
+# One thread per pooled read connection
+worker_class = 'gthread'
+threads = main_api.app.config['DB_POOL_SIZE']
+preload_app = True
+
+
+def worker_exit(server, worker):
+    """
+    Commits the writes still queued for group commit before a worker exits
+    """
+    main_api.close_db()
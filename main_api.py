@@ -1,33 +1,208 @@
 from flask import Flask, g, jsonify, Response, request, render_template
+from flask import make_response, url_for, current_app, has_app_context
+from markupsafe import Markup
 from flask.views import MethodView
+from werkzeug.http import is_resource_modified
+from werkzeug.local import LocalProxy
+import click
+import calendar
+import csv
+import datetime
+import functools
+import gzip
+import io
+import json
 import os
-import sqlite3
+import threading
+import time
 import booking_db
+import metrics
 import requests
 import sys
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 
 # Flask APP Initialization
 app = Flask(__name__)
 app.config['DATABASE'] = os.path.join(app.root_path, 'db.sqlite')
-db = booking_db.BookingDB('db.sqlite')
-
+app.config['DB_POOL_SIZE'] = 5
+# Seconds a request waits for a pooled connection before getting 503
+app.config['DB_POOL_TIMEOUT'] = 10.0
+app.config['DB_PRAGMAS'] = booking_db.DEFAULT_PRAGMAS
+app.config['DB_CONFLICT_SCOPE'] = 'date'
+app.config['CACHE_SIZE'] = 256
+app.config['CACHE_TTL'] = 30.0
+app.config['COMPRESS_MIN_SIZE'] = 1024
+app.config['COMPRESS_LEVEL'] = 6
+app.config['PROFILE'] = False
+app.config['SLOW_QUERY_MS'] = 100
+app.config['TRACE_SQL'] = False
+app.config['DB_GROUP_COMMIT'] = False
+app.config['DB_GROUP_COMMIT_MS'] = 2.0
+app.config['DB_GROUP_COMMIT_ROWS'] = 256
+# What deleting a person or activity with events does: 'restrict' answers
+# 409, 'cascade' deletes the events too
+app.config['DB_ON_DELETE'] = 'restrict'
+app.config['PAGE_SIZE'] = 100
+app.config['MAX_PAGE_SIZE'] = 1000
+app.config['SEARCH_LIMIT'] = 10
+app.config['FRAGMENT_CACHE_SIZE'] = 128
+app.config['FRAGMENT_CACHE_TTL'] = 300.0
+# Threads serving requests under asgi.py, None for one per pooled
+# connection, and how many requests may wait for one before getting 503
+app.config['ASYNC_WORKERS'] = None
+app.config['ASYNC_MAX_QUEUED'] = 1000
+app.config.from_envvar('BOOKING_SETTINGS', silent=True)
+
+registry = metrics.Registry()
+request_count = registry.counter(
+    'http_requests_total', 'HTTP requests handled',
+    ('method', 'route', 'status'))
+request_latency = registry.histogram(
+    'http_request_duration_seconds', 'Time to build HTTP responses',
+    ('method', 'route'))
+db_latency = registry.histogram(
+    'booking_db_method_duration_seconds', 'Time spent in BookingDB methods',
+    ('method',))
+
+
+# Guards opening the database. Replaced in a forked child, where the copy of
+# a lock held by another thread of the parent would never be released
+_open_lock = threading.Lock()
+# Databases inherited from a parent process. SQLite connections must not be
+# used or closed after a fork, so they are kept here and never finalized
+_inherited = []
+
+
+def _reset_after_fork():
+    global _open_lock
+    _open_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def open_db(config):
+    """
+    Opens a BookingDB on the database file and with the settings of an app's
+    config, timed by the metrics registry.
 
-def connect_db():
-    conn = sqlite3.connect(app.config['DATABASE'])
-    conn.row_factory = sqlite3.Row
-    return conn
+    :param config: the app's config
+    :return: the BookingDB
+    """
+    database = booking_db.BookingDB(
+        config['DATABASE'], pool_size=config['DB_POOL_SIZE'],
+        pool_timeout=config['DB_POOL_TIMEOUT'], pragmas=config['DB_PRAGMAS'],
+        conflict_scope=config['DB_CONFLICT_SCOPE'],
+        cache_size=config['CACHE_SIZE'], cache_ttl=config['CACHE_TTL'],
+        profile=config['PROFILE'], slow_query_ms=config['SLOW_QUERY_MS'],
+        trace_sql=config['TRACE_SQL'],
+        group_commit=config['DB_GROUP_COMMIT'],
+        group_commit_ms=config['DB_GROUP_COMMIT_MS'],
+        group_commit_rows=config['DB_GROUP_COMMIT_ROWS'],
+        on_delete=config['DB_ON_DELETE'])
+    metrics.instrument_methods(database, db_latency)
+    return database
+
+
+def _current_app():
+    """
+    Returns the current app, or the module's app outside an app context.
+    """
+    if has_app_context():
+        return current_app._get_current_object()
+    return app
 
 
 def get_db():
-    if not hasattr(g, 'sqlite_db'):
-        g.sqlite_db = connect_db()
-    return g.sqlite_db
+    """
+    Returns this process's BookingDB for the current app, opening it from
+    the app's config on first use. Nothing is opened at import, so a prefork
+    server can load the app and then fork: each worker opens its own
+    connections, group commit writer and caches.
+
+    :return: the BookingDB
+    """
+    target = _current_app()
+    opened = target.extensions.get('booking_db')
+    if opened is not None and opened[0] == os.getpid():
+        return opened[1]
+
+    with _open_lock:
+        opened = target.extensions.get('booking_db')
+        if opened is None or opened[0] != os.getpid():
+            if opened is not None:
+                _inherited.append(opened[1])
+            opened = (os.getpid(), open_db(target.config))
+            target.extensions['booking_db'] = opened
+        return opened[1]
+
+
+def get_fragments():
+    """
+    Returns the cache of rendered page tables of the current app, sized from
+    the app's config on first use. Entries are keyed by database, page, page
+    arguments and the versions of the tables they show, so a write to any of
+    those tables makes them miss without being invalidated.
+
+    :return: the LRUCache
+    """
+    target = _current_app()
+    cache = target.extensions.get('fragments')
+    if cache is None:
+        cache = target.extensions.setdefault('fragments', booking_db.LRUCache(
+            target.config['FRAGMENT_CACHE_SIZE'],
+            target.config['FRAGMENT_CACHE_TTL']))
+    return cache
+
+
+def close_db():
+    """
+    Commits any queued writes and closes this process's BookingDB for the
+    current app, if it is open, and drops its cached page tables. The next
+    use opens both again.
+    """
+    target = _current_app()
+    with _open_lock:
+        opened = target.extensions.pop('booking_db', None)
+    target.extensions.pop('fragments', None)
+    if opened is None:
+        return
+    if opened[0] == os.getpid():
+        opened[1].close()
+    else:
+        _inherited.append(opened[1])
+
+
+# This process's BookingDB for the current app, see get_db()
+db = LocalProxy(get_db)
+
+
+def create_app(config=None):
+    """
+    Configures and returns the application. config overrides the defaults
+    above and the file named by the BOOKING_SETTINGS environment variable.
+    Any database opened under the previous settings is closed, and the
+    database is opened lazily from DATABASE in each process that uses it.
+    Settings left to follow others are worked out from the final config.
+
+    :param config: optional dict of settings
+    :return: the app
+    """
+    if config is not None:
+        app.config.update(config)
+    close_db()
+    if app.config['ASYNC_WORKERS'] is None:
+        app.config['ASYNC_WORKERS'] = app.config['DB_POOL_SIZE']
+    return app
 
 
 def init_db():
-    conn = get_db()
-    conn.commit()
     db.create_tables()
 
 
@@ -37,6 +212,23 @@ def initdb_command():
     print('Initialized the database.')
 
 
+@app.cli.command('migratedb')
+def migratedb_command():
+    try:
+        version = db.migrate()
+    except booking_db.BookingConflict:
+        clashes = db.double_bookings()
+        for slot, event_ids in clashes:
+            print('{}: events {}'.format(
+                ', '.join(map(str, slot)), ', '.join(map(str, event_ids))))
+        raise click.ClickException(
+            '{} slots above hold more than one event, so double bookings '
+            'are not refused yet. Move or delete all but one event in each '
+            '(PATCH or DELETE /api/event/<id>/) and run migratedb '
+            'again.'.format(len(clashes)))
+    print('Migrated the database to schema version {}.'.format(version))
+
+
 class RequestError(Exception):
     """
     This custom exception class is for easily handling errors in requests,
@@ -75,10 +267,520 @@ def handle_invalid_usage(error):
     return error.to_response()
 
 
+@app.errorhandler(booking_db.PoolTimeout)
+def handle_pool_timeout(error):
+    """
+    Answers 503 when every pooled connection stayed busy for longer than
+    DB_POOL_TIMEOUT, so the client retries rather than the request waiting
+    on for good.
+
+    :param error: the PoolTimeout
+    :return: a response asking the client to retry
+    """
+    response = jsonify({'error': 'server busy'})
+    response.status = '503'
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+@app.before_request
+def start_metrics_timer():
+    """
+    Records when the request started, for the request latency histogram.
+    """
+    g.metrics_start = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    """
+    Counts the request and observes its latency, labelled by the matched
+    route rather than the raw path so ids do not create new series.
+
+    :param response: the response
+    :return: the response
+    """
+    if 'metrics_start' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        request_latency.observe((request.method, route),
+                                time.perf_counter() - g.metrics_start)
+        request_count.inc((request.method, route,
+                           str(response.status_code)))
+    return response
+
+
+def _pool_samples():
+    """
+    Returns the connection pool gauges for the metrics registry.
+    """
+    stats = db.pool_stats()
+    return {(('state', state),): stats[state]
+            for state in ('size', 'open', 'in_use')}
+
+
+def _cache_samples():
+    """
+    Returns the read cache hit and miss counts for the metrics registry.
+    """
+    info = db.cache_info()
+    if info is None:
+        return {}
+    return {(('result', 'hit'),): info['hits'],
+            (('result', 'miss'),): info['misses']}
+
+
+def _cache_ratio_samples():
+    """
+    Returns the read cache hit ratio for the metrics registry.
+    """
+    info = db.cache_info()
+    if info is None or not info['hits'] + info['misses']:
+        return {}
+    return {(): info['hits'] / (info['hits'] + info['misses'])}
+
+
+def _writer_samples():
+    """
+    Returns the group commit writer counters for the metrics registry.
+    """
+    stats = db.write_stats()
+    if stats is None:
+        return {}
+    return {(('kind', kind),): stats[kind]
+            for kind in ('batches', 'writes', 'queued')}
+
+
+registry.gauge_callback('booking_db_pool_connections',
+                        'Pooled SQLite connections by state', _pool_samples)
+registry.gauge_callback('booking_db_cache_lookups_total',
+                        'Read cache lookups by result', _cache_samples,
+                        kind='counter')
+registry.gauge_callback('booking_db_cache_hit_ratio',
+                        'Fraction of read cache lookups that were hits',
+                        _cache_ratio_samples)
+registry.gauge_callback('booking_db_group_commit',
+                        'Group commit batches and writes committed, and '
+                        'writes queued', _writer_samples)
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """
+    Serves the metrics in the Prometheus text exposition format.
+    """
+    return Response(registry.render(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.before_request
+def start_timer():
+    """
+    Starts timing the request and counting its queries when PROFILE is on.
+    """
+    if app.config['PROFILE'] and db.profiler is not None:
+        g.request_start = time.perf_counter()
+        db.profiler.begin()
+
+
+@app.after_request
+def add_server_timing(response):
+    """
+    Reports the time spent in SQLite and in the rest of the application in a
+    Server-Timing header when PROFILE is on.
+
+    :param response: the response
+    :return: the response
+    """
+    if 'request_start' not in g:
+        return response
+
+    total_ms = (time.perf_counter() - g.request_start) * 1000
+    count, db_seconds = db.profiler.end()
+    db_ms = db_seconds * 1000
+    response.headers.add(
+        'Server-Timing',
+        'db;dur={:.2f};desc="{} queries", app;dur={:.2f}, total;dur={:.2f}'
+        .format(db_ms, count, total_ms - db_ms, total_ms))
+    return response
+
+
+# Content codings offered for API responses, in order of preference. Brotli is
+# only offered when the optional brotli package is installed.
+CONTENT_CODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+@app.after_request
+def compress_response(response):
+    """
+    Compresses JSON responses larger than COMPRESS_MIN_SIZE with the best
+    content coding the client accepts.
+
+    :param response: the response
+    :return: the possibly compressed response
+    """
+    if (response.status_code != 200 or response.is_streamed or
+            response.direct_passthrough or
+            response.mimetype != 'application/json' or
+            'Content-Encoding' in response.headers):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    coding = request.accept_encodings.best_match(CONTENT_CODINGS)
+    data = response.get_data()
+    if coding is None or len(data) < app.config['COMPRESS_MIN_SIZE']:
+        return response
+
+    if coding == 'br':
+        data = brotli.compress(data, quality=app.config['COMPRESS_LEVEL'])
+    else:
+        data = gzip.compress(data, compresslevel=app.config['COMPRESS_LEVEL'])
+    response.set_data(data)
+    response.headers['Content-Encoding'] = coding
+
+    etag, weak = response.get_etag()
+    if etag is not None:
+        response.set_etag('{}-{}'.format(etag, coding), weak)
+
+    return response
+
+
+def columns_response(table):
+    """
+    Returns a whole table in the compact columnar layout
+    {"columns": [...], "rows": [[...], ...]}. Rows are serialized straight
+    from the cursor tuples, so no dict is built per row and each column name
+    is sent once.
+
+    :param table: person, activity or event
+    :return: JSON response
+    """
+    columns, rows = db.get_all_rows(table)
+    body = json.dumps({'columns': columns, 'rows': rows},
+                      separators=(',', ':'))
+
+    return Response(body, mimetype='application/json')
+
+
+def conditional(*tables, row_version=None):
+    """
+    Decorates a GET handler with ETag and Last-Modified headers derived from
+    the version counters of the tables it reads. A request whose
+    If-None-Match or If-Modified-Since still matches gets a 304 without the
+    handler, and so without its queries, being run. The versions are held
+    in memory by BookingDB.table_versions(), so while nothing is written a
+    304 reads no table.
+
+    If-None-Match decides whenever it is sent. Last-Modified has whole
+    seconds, so it is only sent, and If-Modified-Since only honoured, once
+    the second of the last change is over; otherwise a later write in the
+    same second would not move it.
+
+    :param tables: tables the handler's response depends on
+    :param row_version: function taking the handler's arguments and
+    returning the version of the row it serves, or None. The ETag then
+    starts with that version, so it can be sent back in If-Match
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            versions = db.table_versions(*tables)
+            etag = '-'.join('{}.{}'.format(table, versions[table][0])
+                            for table in tables)
+            version = None if row_version is None else row_version(**kwargs)
+            if version is not None:
+                etag = '{}-{}'.format(version, etag)
+            modified = max(version[1] for version in versions.values())
+            last_modified = None
+            if modified < int(time.time()):
+                last_modified = datetime.datetime.fromtimestamp(
+                    modified, datetime.timezone.utc)
+            since = last_modified
+            if 'If-None-Match' in request.headers:
+                since = None
+
+            # A compressed response carries the ETag with the content coding
+            # appended, so a client holding that variant is also current.
+            for variant in [etag] + ['{}-{}'.format(etag, coding)
+                                     for coding in CONTENT_CODINGS]:
+                if not is_resource_modified(request.environ, etag=variant,
+                                            last_modified=since):
+                    response = Response(status=304)
+                    response.set_etag(variant)
+                    response.vary.add('Accept-Encoding')
+                    return response
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag)
+                if last_modified is not None:
+                    response.last_modified = last_modified
+            return response
+        return wrapper
+    return decorator
+
+
+def page_args():
+    """
+    Reads the keyset pagination parameters 'limit' and 'after_id' from the
+    query string.
+
+    :return: (after_id, limit), or None if the request is not paginated
+    """
+    if 'limit' not in request.args and 'after_id' not in request.args:
+        return None
+
+    try:
+        limit = int(request.args.get('limit', app.config['PAGE_SIZE']))
+        after_id = int(request.args.get('after_id', 0))
+    except ValueError:
+        raise RequestError(422, 'limit and after_id must be integers')
+    if limit < 1:
+        raise RequestError(422, 'limit must be positive')
+    if abs(after_id) > booking_db.MAX_INTEGER:
+        raise RequestError(422, 'after_id out of range')
+
+    return after_id, min(limit, app.config['MAX_PAGE_SIZE'])
+
+
+def ids_arg():
+    """
+    Reads the comma-separated ids of a multi-get from the 'ids' query string
+    parameter.
+
+    :return: list of ids
+    """
+    try:
+        ids = [int(id) for id in request.args['ids'].split(',') if id.strip()]
+    except ValueError:
+        raise RequestError(422, 'ids must be comma-separated integers')
+    if any(abs(id) > booking_db.MAX_INTEGER for id in ids):
+        raise RequestError(422, 'ids out of range')
+    if len(ids) > app.config['MAX_PAGE_SIZE']:
+        raise RequestError(422, 'at most {} ids allowed'.format(
+            app.config['MAX_PAGE_SIZE']))
+
+    return ids
+
+
+def delete_ids(key, id):
+    """
+    Reads the ids a DELETE request addresses: the id in the URL, the form
+    parameter named key, or a JSON body holding a list of ids or an object
+    with an 'ids' list.
+
+    :param key: name of the form parameter
+    :param id: id from the URL, or None
+    :return: (ids, single) where single tells whether the request addressed
+    one row rather than a list
+    """
+    if id is not None:
+        return [id], True
+    if key in request.form:
+        try:
+            id = int(request.form[key])
+        except ValueError:
+            raise RequestError(422, key + ' must be an integer')
+        if abs(id) > booking_db.MAX_INTEGER:
+            raise RequestError(422, key + ' out of range')
+        return [id], True
+
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        body = body.get('ids')
+    if not isinstance(body, list):
+        raise RequestError(422, key + ' or a JSON list of ids required')
+    if len(body) > app.config['MAX_PAGE_SIZE'] * 10:
+        raise RequestError(413, 'too many ids')
+    if not all(isinstance(id, int) and not isinstance(id, bool)
+               for id in body):
+        raise RequestError(422, 'ids must be integers')
+    if any(abs(id) > booking_db.MAX_INTEGER for id in body):
+        raise RequestError(422, 'ids out of range')
+
+    return body, False
+
+
+def delete_response(rows, single, missing, events=None):
+    """
+    Builds the response of a DELETE request.
+
+    :param rows: the deleted rows
+    :param single: whether the request addressed one row
+    :param missing: error message when that row did not exist
+    :param events: ids of events deleted along with the rows, if any
+    :return: the deleted row, or JSON with the list of deleted rows
+    """
+    if single:
+        if not rows:
+            raise RequestError(404, missing)
+        return jsonify(rows[0])
+
+    body = {'deleted': rows}
+    if events is not None:
+        body['deleted_events'] = events
+    return jsonify(body)
+
+
+def search_response(search):
+    """
+    Answers a name search given in the 'q' query string parameter, returning
+    at most 'limit' matches, best first.
+
+    :param search: BookingDB search method
+    :return: JSON response with the matching rows
+    """
+    try:
+        limit = int(request.args.get('limit', app.config['SEARCH_LIMIT']))
+    except ValueError:
+        raise RequestError(422, 'limit must be an integer')
+    if limit < 1:
+        raise RequestError(422, 'limit must be positive')
+
+    return jsonify(search(request.args['q'],
+                          min(limit, app.config['MAX_PAGE_SIZE'])))
+
+
+def page_response(get_page, key, after_id, limit):
+    """
+    Returns one page of results along with the cursor for the next page. One
+    row more than requested is fetched so that 'next' is null on the last
+    page without an extra round trip.
+
+    :param get_page: BookingDB page method
+    :param key: primary key column used as the cursor
+    :param after_id: cursor of the previous page
+    :param limit: page size
+    :return: JSON response with 'items' and 'next'
+    """
+    items = get_page(after_id, limit + 1)
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = items[-1][key]
+
+    return jsonify({'items': items, 'next': next_cursor})
+
+
+# Fields of an event that PUT and PATCH can change
+EVENT_FIELDS = ('person_id', 'activity_id', 'date', 'amount')
+
+
+def update_body():
+    """
+    Reads the fields of a PUT or PATCH request from a JSON object or from
+    form data.
+
+    :return: dict of the event fields given
+    """
+    body = request.get_json(silent=True)
+    if body is None:
+        body = request.form.to_dict()
+    if not isinstance(body, dict):
+        raise RequestError(422, 'a JSON object or form data required')
+
+    changes = {}
+    for field, value in body.items():
+        if field not in EVENT_FIELDS + ('currency',):
+            raise RequestError(422, 'unknown field: ' + field)
+        if field in ('person_id', 'activity_id'):
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise RequestError(422, field + ' must be an integer')
+        if field == 'date' and (not isinstance(value, str) or not value):
+            raise RequestError(422, 'date must be a non-empty string')
+        changes[field] = value
+
+    return changes
+
+
+def if_match_version():
+    """
+    Reads the version an update is based on from the If-Match header, which
+    holds the 'version' of the event as last read, quoted or not, or the
+    ETag of a GET of the event, which starts with that version.
+
+    :return: the version, or None if the header is absent or '*'
+    """
+    header = request.headers.get('If-Match')
+    if header is None or header.strip() == '*':
+        return None
+    try:
+        return int(header.strip().lstrip('W/').strip('"').split('-', 1)[0])
+    except ValueError:
+        raise RequestError(422, 'If-Match must be an event version')
+
+
+def update_event(event_id, changes):
+    """
+    Applies a PUT or PATCH to an event, honouring If-Match.
+
+    :param event_id: id of the event
+    :param changes: dict of the fields to change
+    :return: JSON response representing the updated event
+    """
+    try:
+        event = db.update_event(event_id, changes, if_match_version())
+    except booking_db.VersionConflict as e:
+        response = RequestError(409, str(e)).to_response()
+        response.set_etag(str(e.version))
+        return response
+    except booking_db.BookingConflict as e:
+        raise RequestError(409, str(e))
+    except ValueError as e:
+        raise RequestError(422, str(e))
+    if event is None:
+        raise RequestError(404, 'event not found')
+
+    event = db.get_event_by_id(event_id) or event
+    response = jsonify(event)
+    response.set_etag(str(event['version']))
+    return response
+
+
+def event_version(event_id):
+    """
+    Returns the version of an event for its ETag.
+
+    :param event_id: id of the event, None for lists of events
+    :return: the version, or None for lists and missing events
+    """
+    if event_id is None:
+        return None
+    event = db.get_event_by_id(event_id)
+    return None if event is None else event['version']
+
+
 class EventView(MethodView):
 
+    @conditional('event', 'person', 'activity', row_version=event_version)
     def get(self, event_id):
         if event_id is None:
+            # A date range is its own query, so it is not silently dropped
+            # in favour of another one
+            if ('from' in request.args or 'to' in request.args) and \
+                    ('ids' in request.args or 'limit' in request.args or
+                     'after_id' in request.args or 'format' in request.args):
+                raise RequestError(422, 'from and to cannot be combined with '
+                                        'ids, limit, after_id or format')
+
+            if 'ids' in request.args:
+                return jsonify(db.get_events_by_ids(ids_arg()))
+
+            page = page_args()
+            if page is not None:
+                return page_response(db.get_events_page, 'event_id', *page)
+
+            if request.args.get('format') == 'columns':
+                return columns_response('event')
+
+            if 'from' in request.args or 'to' in request.args:
+                try:
+                    return jsonify(db.get_events_between(
+                        request.args.get('from'), request.args.get('to')))
+                except ValueError as e:
+                    raise RequestError(422, str(e))
+
             all_events = db.get_all_events()
             return jsonify(all_events)
         else:
@@ -87,9 +789,9 @@ class EventView(MethodView):
             if event is not None:
                 response = jsonify(event)
             else:
-                raise RequestError(404, 'race not found')
+                raise RequestError(404, 'event not found')
 
-            return event
+            return response
 
     def post(self):
         """
@@ -111,42 +813,69 @@ class EventView(MethodView):
         if 'amount' not in request.form:
             raise RequestError(422, 'amount required')
         else:
-            response = jsonify(db.insert_event(
-                request.form['person_id'],
-                request.form['activity_id'],
-                request.form['date'],
-                request.form['amount']
-            ))
+            try:
+                event_id = db.insert_event(
+                    request.form['person_id'],
+                    request.form['activity_id'],
+                    request.form['date'],
+                    request.form['amount'],
+                    request.form.get('currency')
+                )
+            except booking_db.BookingConflict as e:
+                raise RequestError(409, str(e))
+            except ValueError as e:
+                raise RequestError(422, str(e))
+            response = jsonify(db.get_event_by_id(event_id))
 
         return response
 
-    def delete(self, event_id):
+    def put(self, event_id):
+        """
+        Implements PUT /api/event/<event_id>/, replacing every field of the
+        event: person_id, activity_id, date, amount and optionally currency.
+
+        :return: JSON response representing the updated event
         """
-        Implements DELETE /class
+        changes = update_body()
+        for field in EVENT_FIELDS:
+            if field not in changes:
+                raise RequestError(422, field + ' required')
+        changes.setdefault('currency', None)
 
-        Requires the form parameter 'class_id'
+        return update_event(event_id, changes)
 
-        :return: JSON response representing the deleted class
+    def patch(self, event_id):
         """
+        Implements PATCH /api/event/<event_id>/, changing only the fields
+        given.
 
-        # request.form is a dictionary of the form data contained
-        # in the request
-        if 'event_id' not in request.form:
-            raise RequestError(422, 'event_id required')
-        else:
-            deleted_event = db.get_event_by_id(
-                request.form['event_id'])
-            db.delete_event(request.form['event_id'])
-        return jsonify(deleted_event)
+        :return: JSON response representing the updated event
+        """
+        changes = update_body()
+        if not changes:
+            raise RequestError(422, 'nothing to update')
+
+        return update_event(event_id, changes)
+
+    def delete(self, event_id):
+        """
+        Implements DELETE /api/event/<event_id>/ and DELETE /api/event/
+
+        The latter takes the ids to delete as a JSON list, or the form
+        parameter 'event_id'.
+
+        :return: JSON response representing the deleted events
+        """
+        ids, single = delete_ids('event_id', event_id)
+        return delete_response(db.delete_events(ids), single,
+                               'event not found')
 
 
 class ActivityView(MethodView):
     """
     This view handles all the activity requests.
     """
-    def __init__(self):
-        self._db = booking_db.BookingDB('db.sqlite')
-
+    @conditional('activity')
     def get(self, activity_id):
         """
         Handle GET requests.
@@ -158,10 +887,24 @@ class ActivityView(MethodView):
         :return: JSON response
         """
         if activity_id is None:
-            all_activities = self._db.get_all_activities()
+            if 'ids' in request.args:
+                return jsonify(db.get_activities_by_ids(ids_arg()))
+
+            if 'q' in request.args:
+                return search_response(db.search_activities)
+
+            page = page_args()
+            if page is not None:
+                return page_response(db.get_activities_page, 'activity_id',
+                                     *page)
+
+            if request.args.get('format') == 'columns':
+                return columns_response('activity')
+
+            all_activities = db.get_all_activities()
             return jsonify(all_activities)
         else:
-            activity = self._db.get_activity_by_id(activity_id)
+            activity = db.get_activity_by_id(activity_id)
 
             if activity is not None:
                 response = jsonify(activity)
@@ -184,39 +927,35 @@ class ActivityView(MethodView):
         if 'name' not in request.form:
             raise RequestError(422, 'activity name required')
         else:
-            response = jsonify(self._db.insert_activity(
-                request.form['name']
-            ))
+            activity_id = db.insert_activity(request.form['name'])
+            response = jsonify(db.get_activity_by_id(activity_id))
 
         return response
 
-    def delete(self):
+    def delete(self, activity_id):
         """
-        Implements DELETE /class
+        Implements DELETE /api/activity/<activity_id> and DELETE
+        /api/activity/
 
-        Requires the form parameter 'class_id'
+        The latter takes the ids to delete as a JSON list, or the form
+        parameter 'activity_id'.
 
-        :return: JSON response representing the deleted class
+        :return: JSON response representing the deleted activities
         """
-
-        # request.form is a dictionary of the form data contained
-        # in the request
-        if 'activity_id' not in request.form:
-            raise RequestError(422, 'activity_id required')
-        else:
-            deleted_activity = self._db.get_activity_by_id(
-                request.form['activity_id'])
-            self._db.delete_activity(request.form['activity_id'])
-        return jsonify(deleted_activity)
+        ids, single = delete_ids('activity_id', activity_id)
+        try:
+            activities, events = db.delete_activities(ids)
+        except booking_db.StillReferenced as e:
+            raise RequestError(409, str(e))
+        return delete_response(activities, single, 'activity not found',
+                               events)
 
 
 class PersonView(MethodView):
     """
     This view handles all the activity requests.
     """
-    def __init__(self):
-        self._db = booking_db.BookingDB('db.sqlite')
-
+    @conditional('person')
     def get(self, person_id):
         """
         Handle GET requests.
@@ -228,10 +967,23 @@ class PersonView(MethodView):
         :return: JSON response
         """
         if person_id is None:
-            all_people = self._db.get_all_people()
+            if 'ids' in request.args:
+                return jsonify(db.get_people_by_ids(ids_arg()))
+
+            if 'q' in request.args:
+                return search_response(db.search_people)
+
+            page = page_args()
+            if page is not None:
+                return page_response(db.get_people_page, 'person_id', *page)
+
+            if request.args.get('format') == 'columns':
+                return columns_response('person')
+
+            all_people = db.get_all_people()
             return jsonify(all_people)
         else:
-            person = self._db.get_person_by_id(person_id)
+            person = db.get_person_by_id(person_id)
 
             if person is not None:
                 response = jsonify(person)
@@ -254,30 +1006,26 @@ class PersonView(MethodView):
         if 'name' not in request.form:
             raise RequestError(422, 'person name required')
         else:
-            response = jsonify(self._db.insert_person(
-                request.form['name']
-            ))
+            person_id = db.insert_person(request.form['name'])
+            response = jsonify(db.get_person_by_id(person_id))
 
         return response
 
-    def delete(self):
+    def delete(self, person_id):
         """
-        Implements DELETE /class
+        Implements DELETE /api/person/<person_id> and DELETE /api/person/
 
-        Requires the form parameter 'class_id'
+        The latter takes the ids to delete as a JSON list, or the form
+        parameter 'person_id'.
 
-        :return: JSON response representing the deleted class
+        :return: JSON response representing the deleted people
         """
-
-        # request.form is a dictionary of the form data contained
-        # in the request
-        if 'person_id' not in request.form:
-            raise RequestError(422, 'person_id required')
-        else:
-            deleted_person = self._db.get_person_by_id(
-                request.form['person_id'])
-            self._db.delete_person(request.form['person_id'])
-        return jsonify(deleted_person)
+        ids, single = delete_ids('person_id', person_id)
+        try:
+            people, events = db.delete_people(ids)
+        except booking_db.StillReferenced as e:
+            raise RequestError(409, str(e))
+        return delete_response(people, single, 'person not found', events)
 
 
 # Register LeagueView as the handler for all the /event/ requests.
@@ -286,9 +1034,234 @@ app.add_url_rule('/api/event/', defaults={'event_id': None},
                  view_func=event_view, methods=['GET'])
 app.add_url_rule('/api/event/', view_func=event_view, methods=['POST'])
 app.add_url_rule('/api/event/<int:event_id>/', view_func=event_view,
-                 methods=['GET'])
-app.add_url_rule('/api/event/', view_func=event_view,
-                 methods=['DELETE'])
+                 methods=['GET', 'PUT', 'PATCH', 'DELETE'])
+app.add_url_rule('/api/event/', defaults={'event_id': None},
+                 view_func=event_view, methods=['DELETE'])
+
+
+def bulk_body():
+    """
+    Reads the body of a bulk request, either a JSON array or newline-delimited
+    JSON with one object per line.
+
+    :return: list of decoded items
+    """
+    if request.mimetype == 'application/x-ndjson':
+        try:
+            return [json.loads(line) for line in
+                    request.get_data(as_text=True).splitlines()
+                    if line.strip()]
+        except ValueError:
+            raise RequestError(422, 'body must be newline-delimited JSON')
+
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        raise RequestError(422, 'body must be a JSON array')
+
+    return items
+
+
+def validate_event(item):
+    """
+    Checks one event of a bulk request and converts its fields.
+
+    :param item: decoded JSON object
+    :return: (person_id, activity_id, date, amount, currency) tuple
+    """
+    if not isinstance(item, dict):
+        raise ValueError('event must be an object')
+    for field in ('person_id', 'activity_id', 'date', 'amount'):
+        if field not in item:
+            raise ValueError(field + ' required')
+    if not isinstance(item['date'], str) or not item['date']:
+        raise ValueError('date must be a non-empty string')
+
+    booking_db.to_cents(item['amount'])
+
+    return (int(item['person_id']), int(item['activity_id']), item['date'],
+            item['amount'],
+            booking_db.normalize_currency(item.get('currency')))
+
+
+@app.route('/api/event/bulk', methods=['POST'])
+def bulk_insert_events():
+    """
+    Books many events at once. Every event is validated before anything is
+    written, then the valid ones are inserted in a single transaction.
+
+    :return: JSON with the new id of each event (null if it was rejected) and
+    a list of per-event errors
+    """
+    items = bulk_body()
+    events = []
+    indexes = []
+    errors = {}
+    for index, item in enumerate(items):
+        try:
+            events.append(validate_event(item))
+            indexes.append(index)
+        except (TypeError, ValueError) as e:
+            errors[index] = str(e)
+
+    ids = [None] * len(items)
+    new_ids, insert_errors = db.insert_events(events)
+    for position, index in enumerate(indexes):
+        ids[index] = new_ids[position]
+        if position in insert_errors:
+            errors[index] = insert_errors[position]
+
+    return jsonify({
+        'ids': ids,
+        'errors': [{'index': index, 'error': errors[index]}
+                   for index in sorted(errors)],
+    })
+
+
+def bulk_names():
+    """
+    Reads the names of a bulk person or activity import. Each item may be a
+    name or an object with a 'name' field.
+
+    :return: list of names
+    """
+    names = []
+    for index, item in enumerate(bulk_body()):
+        if isinstance(item, dict):
+            item = item.get('name')
+        if not isinstance(item, str) or not item:
+            raise RequestError(
+                422, 'item {} must be a non-empty name'.format(index))
+        names.append(item)
+
+    return names
+
+
+@app.route('/api/person/bulk', methods=['POST'])
+def bulk_import_people():
+    """
+    Imports many people at once, creating only the names not already
+    present.
+
+    :return: JSON object mapping each name to its person_id
+    """
+    return jsonify(db.import_people(bulk_names()))
+
+
+@app.route('/api/activity/bulk', methods=['POST'])
+def bulk_import_activities():
+    """
+    Imports many activities at once, creating only the names not already
+    present.
+
+    :return: JSON object mapping each name to its activity_id
+    """
+    return jsonify(db.import_activities(bulk_names()))
+
+
+@app.route('/api/event/export')
+def export_events():
+    """
+    Streams the event overview as NDJSON (the default) or as CSV with
+    ?format=csv. Rows are read from the database in batches while the
+    response is being sent, so the whole table is never held in memory.
+
+    :return: streaming response
+    """
+    export_format = request.args.get('format', 'ndjson')
+    if export_format == 'ndjson':
+        body = _ndjson_lines(db.iter_overview())
+        mimetype = 'application/x-ndjson'
+    elif export_format == 'csv':
+        body = _csv_lines(db.iter_overview())
+        mimetype = 'text/csv'
+    else:
+        raise RequestError(422, 'format must be ndjson or csv')
+
+    return Response(body, mimetype=mimetype)
+
+
+def _ndjson_lines(rows):
+    """
+    Encodes rows as newline-delimited JSON.
+
+    :param rows: generator of dicts
+    :return: generator of lines
+    """
+    try:
+        for row in rows:
+            yield json.dumps(row) + '\n'
+    finally:
+        rows.close()
+
+
+def _csv_lines(rows):
+    """
+    Encodes rows as CSV with a header line.
+
+    :param rows: generator of dicts
+    :return: generator of lines
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    try:
+        header_written = False
+        for row in rows:
+            if not header_written:
+                writer.writerow(row.keys())
+                header_written = True
+            writer.writerow(row.values())
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    finally:
+        rows.close()
+
+
+@app.route('/api/calendar/<int:year>/<int:month>')
+def month_calendar(year, month):
+    """
+    Returns how many events are booked on each day of a month.
+
+    :param year: year of the month
+    :param month: month number, 1-12
+    :return: JSON with one entry per day of the month
+    """
+    if not 1 <= month <= 12 or not datetime.MINYEAR <= year <= \
+            datetime.MAXYEAR:
+        raise RequestError(404, 'month not found')
+
+    days_in_month = calendar.monthrange(year, month)[1]
+    first = datetime.date(year, month, 1)
+    last = datetime.date(year, month, days_in_month)
+    occupancy = db.get_occupancy(first, last)
+
+    days = []
+    for day in range(1, days_in_month + 1):
+        date = datetime.date(year, month, day).isoformat()
+        days.append({'date': date, 'events': occupancy.get(date, 0)})
+
+    return jsonify({'year': year, 'month': month, 'days': days})
+
+
+@app.route('/api/report/<group>')
+@conditional('event', 'person', 'activity')
+def report(group):
+    """
+    Returns event counts and total amounts grouped by activity, person, day
+    or month. Day and month reports accept 'from' and 'to' dates.
+
+    :param group: activity, person, day or month
+    :return: JSON list with one entry per group
+    """
+    if group not in ('activity', 'person', 'day', 'month'):
+        raise RequestError(404, 'report not found')
+
+    try:
+        return jsonify(db.get_report(group, request.args.get('from'),
+                                     request.args.get('to')))
+    except ValueError as e:
+        raise RequestError(422, str(e))
+
 
 # Register LeagueView as the handler for all the /activity/ requests.
 activity_view = ActivityView.as_view('activity_view')
@@ -296,9 +1269,9 @@ app.add_url_rule('/api/activity/', defaults={'activity_id': None},
                  view_func=activity_view, methods=['GET'])
 app.add_url_rule('/api/activity/', view_func=activity_view, methods=['POST'])
 app.add_url_rule('/api/activity/<int:activity_id>', view_func=activity_view,
-                 methods=['GET'])
-app.add_url_rule('/api/activity/', view_func=activity_view,
-                 methods=['DELETE'])
+                 methods=['GET', 'DELETE'])
+app.add_url_rule('/api/activity/', defaults={'activity_id': None},
+                 view_func=activity_view, methods=['DELETE'])
 
 # Register LeagueView as the handler for all the /person/ requests.
 person_view = PersonView.as_view('person_view')
@@ -306,9 +1279,9 @@ app.add_url_rule('/api/person/', defaults={'person_id': None},
                  view_func=person_view, methods=['GET'])
 app.add_url_rule('/api/person/', view_func=person_view, methods=['POST'])
 app.add_url_rule('/api/person/<int:person_id>', view_func=person_view,
-                 methods=['GET'])
-app.add_url_rule('/api/person/', view_func=person_view,
-                 methods=['DELETE'])
+                 methods=['GET', 'DELETE'])
+app.add_url_rule('/api/person/', defaults={'person_id': None},
+                 view_func=person_view, methods=['DELETE'])
 
 
 @app.route('/')
@@ -320,16 +1293,108 @@ def home():
     return render_template('home.html')
 
 
+# Columns of the table on each page: (header, name in the rows, sort name
+# or None if the table cannot be sorted on it)
+PAGE_COLUMNS = {
+    'overview': [('#', 'id', 'id'), ('Person', 'person', None),
+                 ('Activity', 'activity', None), ('Date', 'date', 'date'),
+                 ('Amount', 'amount', None)],
+    'person': [('#', 'person_id', 'id'), ('Name', 'name', 'name')],
+    'activity': [('#', 'activity_id', 'id'), ('Name', 'name', 'name')],
+}
+
+
+def listing_args(listing):
+    """
+    Reads the sort and keyset pagination parameters of a page from the query
+    string: 'sort', 'order' (asc or desc), 'limit', and the cursor of the
+    previous page's last row, 'after_id' and, unless sorting by id, 'after'.
+
+    :param listing: name of a listing in booking_db.LISTINGS
+    :return: (sort, descending, after, limit)
+    """
+    sort = request.args.get('sort', 'id')
+    if sort not in booking_db.LISTINGS[listing][2]:
+        raise RequestError(422, 'cannot sort by ' + sort)
+    order = request.args.get('order', 'asc')
+    if order not in ('asc', 'desc'):
+        raise RequestError(422, 'order must be asc or desc')
+
+    try:
+        limit = int(request.args.get('limit', app.config['PAGE_SIZE']))
+        after_id = request.args.get('after_id')
+        after_id = None if after_id is None else int(after_id)
+    except ValueError:
+        raise RequestError(422, 'limit and after_id must be integers')
+    if limit < 1:
+        raise RequestError(422, 'limit must be positive')
+
+    after = None
+    if after_id is not None:
+        if abs(after_id) > booking_db.MAX_INTEGER:
+            raise RequestError(422, 'after_id out of range')
+        if sort == 'id':
+            after = (after_id, after_id)
+        elif 'after' in request.args:
+            after = (request.args['after'], after_id)
+        else:
+            raise RequestError(422, 'after is required with after_id when '
+                                    'sorting by ' + sort)
+
+    return (sort, order == 'desc', after,
+            min(limit, app.config['MAX_PAGE_SIZE']))
+
+
+def render_listing(listing, *tables):
+    """
+    Renders the table of a page from one keyset page of a listing. Rendered
+    tables are cached, so repeated views of a page skip both the query and
+    the rendering until one of the tables it shows is written to.
+
+    :param listing: name of a listing in booking_db.LISTINGS
+    :param tables: tables the listing reads
+    :return: the table as Markup
+    """
+    sort, descending, after, limit = listing_args(listing)
+    versions = db.table_versions(*tables)
+    key = (current_app.config['DATABASE'], listing, request.endpoint, sort,
+           descending, after, limit) + \
+        tuple(versions[table][0] for table in tables)
+    hit, html = get_fragments().get(key)
+    if hit:
+        return Markup(html)
+
+    rows = db.get_listing_page(listing, sort, descending, after, limit + 1)
+    next_url = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        sorts = booking_db.LISTINGS[listing][2]
+        last = rows[-1]
+        next_args = {'sort': sort, 'limit': limit,
+                     'after_id': last[booking_db.LISTINGS[listing][1][1]]}
+        if descending:
+            next_args['order'] = 'desc'
+        if sort != 'id':
+            next_args['after'] = last[sorts[sort][1]]
+        next_url = url_for(request.endpoint, **next_args)
+
+    html = render_template('table_page.html', rows=rows,
+                           columns=PAGE_COLUMNS[listing], sort=sort,
+                           descending=descending, limit=limit,
+                           next_url=next_url)
+    get_fragments().put(key, html, (), ())
+    return Markup(html)
+
+
 @app.route('/event')
 def event():
     """
     Serves a main page.
     """
 
-    print(booking_db.BookingDB('db.sqlite').overview())
-
     return render_template(
-        'event.html', events=db.overview())
+        'event.html',
+        table=render_listing('overview', 'event', 'person', 'activity'))
 
 
 @app.route('/activity')
@@ -340,7 +1405,7 @@ def activity():
 
     return render_template(
         'activity.html',
-        activities=booking_db.BookingDB('db.sqlite').get_all_activities())
+        table=render_listing('activity', 'activity'))
 
 
 @app.route('/person')
@@ -351,4 +1416,4 @@ def person_and_payment():
 
     return render_template(
         'person.html',
-        people=booking_db.BookingDB('db.sqlite').get_all_people())
+        table=render_listing('person', 'person'))
@@ -0,0 +1,241 @@
+"""
+Minimal Prometheus-style metrics: counters and histograms with labels, and a
+registry rendering them in the Prometheus text exposition format.
+
+Each metric guards its values with its own lock, held only for a dict update,
+so threads recording different metrics never contend and threads recording
+the same metric wait for at most a few instructions.
+"""
+import bisect
+import functools
+import inspect
+import threading
+import time
+
+
+# Default histogram buckets in seconds, suited to request and query latency
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values, extra=()):
+    """
+    Formats label pairs as {name="value",...}
+    :param names: label names
+    :param values: label values, in the same order
+    :param extra: additional (name, value) pairs
+    :return: the formatted labels, or '' if there are none
+    """
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    """
+    Formats a sample value
+    :param value: int or float
+    :return: the value as text
+    """
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Counter:
+    """
+    Monotonically increasing count, one per combination of label values
+    """
+    def __init__(self, name, documentation, labelnames=()):
+        """
+        Initializes the counter
+        :param name: metric name
+        :param documentation: HELP text
+        :param labelnames: names of the labels
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        """
+        Increments the counter
+        :param labels: label values, in the order of labelnames
+        :param amount: amount to add
+        """
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def collect(self):
+        """
+        Renders the counter
+        :return: list of exposition lines
+        """
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} counter'.format(self.name)]
+        for labels, value in values:
+            lines.append('{}{} {}'.format(
+                self.name, _format_labels(self.labelnames, labels),
+                _format_value(value)))
+        return lines
+
+
+class Histogram:
+    """
+    Distribution of observed values in cumulative buckets, one per
+    combination of label values
+    """
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=LATENCY_BUCKETS):
+        """
+        Initializes the histogram
+        :param name: metric name
+        :param documentation: HELP text
+        :param labelnames: names of the labels
+        :param buckets: upper bounds of the buckets, ascending
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        """
+        Records one observation
+        :param labels: label values, in the order of labelnames
+        :param value: observed value
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [
+                    [0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def collect(self):
+        """
+        Renders the histogram
+        :return: list of exposition lines
+        """
+        with self._lock:
+            values = sorted((labels, (list(state[0]), state[1]))
+                            for labels, state in self._values.items())
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} histogram'.format(self.name)]
+        bounds = self.buckets + (float('inf'),)
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, _format_labels(self.labelnames, labels,
+                                              [('le', _format_value(bound))]),
+                    cumulative))
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append('{}_sum{} {}'.format(self.name, label_text,
+                                              _format_value(total)))
+            lines.append('{}_count{} {}'.format(self.name, label_text,
+                                                cumulative))
+        return lines
+
+
+class Registry:
+    """
+    Set of metrics and of callbacks producing samples at scrape time
+    """
+    def __init__(self):
+        self._metrics = []
+        self._callbacks = []
+
+    def counter(self, name, documentation, labelnames=()):
+        """
+        Creates and registers a Counter
+        :return: the counter
+        """
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(),
+                  buckets=LATENCY_BUCKETS):
+        """
+        Creates and registers a Histogram
+        :return: the histogram
+        """
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge_callback(self, name, documentation, callback, kind='gauge'):
+        """
+        Registers a metric whose samples are read from a callback when the
+        registry is rendered
+        :param name: metric name
+        :param documentation: HELP text
+        :param callback: function returning a dict mapping label dicts, as
+        tuples of (name, value) pairs, to values
+        :param kind: Prometheus metric type, gauge or counter
+        """
+        self._callbacks.append((name, documentation, callback, kind))
+
+    def render(self):
+        """
+        Renders every metric in the text exposition format
+        :return: the exposition text
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        for name, documentation, callback, kind in self._callbacks:
+            samples = callback()
+            if not samples:
+                continue
+            lines.append('# HELP {} {}'.format(name, documentation))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in sorted(samples.items()):
+                lines.append('{}{} {}'.format(
+                    name, _format_labels((), (), labels),
+                    _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def instrument_methods(obj, histogram):
+    """
+    Wraps every public method of an object so its duration is observed in a
+    histogram labelled by method name. Generator methods are left alone, as
+    their work happens after they return.
+    :param obj: the object to instrument
+    :param histogram: Histogram with a single 'method' label
+    """
+    for name, method in inspect.getmembers(type(obj), inspect.isfunction):
+        if name.startswith('_') or inspect.isgeneratorfunction(method):
+            continue
+        setattr(obj, name, _timed(getattr(obj, name), histogram, (name,)))
+
+
+def _timed(method, histogram, labels):
+    """
+    Wraps a bound method so its duration is observed in a histogram
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            histogram.observe(labels, time.perf_counter() - start)
+    return wrapper
@@ -1,26 +1,37 @@
+import asyncio
+import datetime
+import gzip
+import jinja2
 import pytest
 import tempfile
 import json
 import os
+import sqlite3
+import threading
+import analytics
+import asgi
+import booking_db
 import main_api
+import metrics
 
 
 @pytest.fixture
 def test_client():
 
-    db_fd, main_api.app.config['DATABASE'] = tempfile.mkstemp()
+    db_fd, database = tempfile.mkstemp()
 
-    main_api.app.testing = True
+    app = main_api.create_app({'DATABASE': database, 'TESTING': True})
 
-    test_client = main_api.app.test_client()
+    test_client = app.test_client()
 
-    with main_api.app.app_context():
+    with app.app_context():
         main_api.init_db()
 
     yield test_client
 
+    main_api.close_db()
     os.close(db_fd)
-    os.unlink(main_api.app.config['DATABASE'])
+    os.unlink(database)
 
 
 def test_no_events(test_client):
@@ -236,11 +247,11 @@ def test_update_event(test_client):
     """
     Tests the PUT method of event
     """
-    person = 'Carl'
-    activity = 'Birthday'
+    person = {'name': 'Carl'}
+    activity = {'name': 'Birthday'}
     event = {
-        'person': 'Carl',
-        'activity': 'Birthday',
+        'person_id': 1,
+        'activity_id': 1,
         'date': 'May-24-2019',
         'amount': 400.00,
     }
@@ -254,8 +265,8 @@ def test_update_event(test_client):
     assert response.status_code == 200
 
     new_event = {
-        'person': 'Carl',
-        'activity': 'Birthday',
+        'person_id': 1,
+        'activity_id': 1,
         'date': 'May-24-2009',
         'amount': 400.00,
     }
@@ -272,7 +283,7 @@ def test_update_event(test_client):
         'event_id': 1,
         'person': 'Carl',
         'activity': 'Birthday',
-        'date': 'May-24-2009',
+        'date': '2009-05-24',
         'amount': 400.00,
     }
 
@@ -326,11 +337,11 @@ def test_same_day_error(test_client):
     Tests the client receives an error when an user tries to post an event on a
     day that already has an event
     """
-    person = 'Carl'
-    activity = 'Birthday'
+    person = {'name': 'Carl'}
+    activity = {'name': 'Birthday'}
     event = {
-        'person': 'Carl',
-        'activity': 'Birthday',
+        'person_id': 1,
+        'activity_id': 1,
         'date': 'Aug-14-2004',
         'amount': 400.00,
         }
@@ -343,11 +354,11 @@ def test_same_day_error(test_client):
     response = test_client.post('/api/event/', data=event)
     assert response.status_code == 200
 
-    person = 'Mrs. Smith'
-    activity = 'Wedding'
+    person = {'name': 'Mrs. Smith'}
+    activity = {'name': 'Wedding'}
     event = {
-        'person': 'Mrs. Smith',
-        'activity': 'Wedding',
+        'person_id': 2,
+        'activity_id': 2,
         'amount': 1600.00,
         'date': 'Aug-14-2004',
         }
@@ -359,3 +370,1529 @@ def test_same_day_error(test_client):
 
     response = test_client.post('/api/event/', data=event)
     assert response.status_code == 409
+
+
+def test_pool_reuses_connections(tmp_path):
+    """
+    Tests that BookingDB hands the same pooled connection back out instead of
+    opening a new one per call
+    """
+    db = booking_db.BookingDB(str(tmp_path / 'pool.sqlite'), pool_size=2)
+    db.create_tables()
+
+    with db._pool.connection() as first:
+        pass
+    with db._pool.connection() as second:
+        pass
+
+    assert first is second
+    db.close()
+
+
+def test_pool_across_threads(tmp_path):
+    """
+    Tests that pooled connections can be used from worker threads without
+    sqlite3 thread errors
+    """
+    db = booking_db.BookingDB(str(tmp_path / 'pool.sqlite'), pool_size=2)
+    db.create_tables()
+    db.insert_person('Carl')
+
+    errors = []
+
+    def worker():
+        try:
+            for _ in range(20):
+                assert db.get_all_people() == [{'person_id': 1,
+                                                'name': 'Carl'}]
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert db._pool._idle.qsize() <= 2
+    db.close()
+
+
+def test_pragma_profile(tmp_path):
+    """
+    Tests that the default PRAGMA profile is applied to pooled connections,
+    that a custom profile replaces it, and that foreign keys stay on unless
+    the profile turns them off
+    """
+    db = booking_db.BookingDB(str(tmp_path / 'wal.sqlite'))
+    with db._pool.connection() as conn:
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert conn.execute('PRAGMA synchronous').fetchone()[0] == 1
+        assert conn.execute('PRAGMA foreign_keys').fetchone()[0] == 1
+        assert conn.execute('PRAGMA busy_timeout').fetchone()[0] == 5000
+    db.close()
+
+    db = booking_db.BookingDB(str(tmp_path / 'plain.sqlite'),
+                              pragmas={'foreign_keys': 'OFF'})
+    with db._pool.connection() as conn:
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'delete'
+        assert conn.execute('PRAGMA foreign_keys').fetchone()[0] == 0
+    db.close()
+
+    db = booking_db.BookingDB(str(tmp_path / 'tuned.sqlite'),
+                              pragmas={'cache_size': -2000})
+    with db._pool.connection() as conn:
+        assert conn.execute('PRAGMA cache_size').fetchone()[0] == -2000
+        assert conn.execute('PRAGMA foreign_keys').fetchone()[0] == 1
+    db.close()
+
+
+def test_event_lookups_use_indexes(tmp_path):
+    """
+    Tests that event lookups by person, activity and date use the secondary
+    indexes instead of scanning the event table
+    """
+    for scope, date_index in (('date', 'ux_event_slot'),
+                              ('activity', 'idx_event_date')):
+        db = booking_db.BookingDB(str(tmp_path / 'index.sqlite'),
+                                  conflict_scope=scope)
+        db.create_tables()
+
+        queries = {
+            'SELECT * FROM event WHERE event.person_id = ?':
+                ('idx_event_person_date',),
+            'SELECT * FROM event WHERE event.activity_id = ?':
+                ('idx_event_activity_date', 'ux_event_slot'),
+            'SELECT * FROM event WHERE event.date = ?': (date_index,),
+        }
+        for query, indexes in queries.items():
+            plan = ' '.join(db.query_plan(query, (1,)))
+            assert any('USING INDEX ' + index in plan
+                       for index in indexes), plan
+            assert 'SCAN' not in plan, plan
+        db.close()
+
+
+def test_migrate_existing_database(tmp_path):
+    """
+    Tests that migrating a database created with the original schema adds the
+    indexes and keeps the existing rows
+    """
+    filename = str(tmp_path / 'old.sqlite')
+    conn = sqlite3.connect(filename)
+    conn.execute('CREATE TABLE person(person_id INTEGER PRIMARY KEY, '
+                 'name TEXT)')
+    conn.execute('CREATE TABLE activity(activity_id INTEGER PRIMARY KEY, '
+                 'name TEXT)')
+    conn.execute('CREATE TABLE event(event_id INTEGER PRIMARY KEY, '
+                 'person_id INTEGER, activity_id INTEGER, date TEXT, '
+                 'amount FLOAT)')
+    conn.execute("INSERT INTO person(name) VALUES('Carl')")
+    conn.execute("INSERT INTO activity(name) VALUES('Birthday')")
+    conn.execute("INSERT INTO event(person_id, activity_id, date, amount) "
+                 "VALUES(1, 1, 'Aug-14-2004', 400.0)")
+    conn.commit()
+    conn.close()
+
+    db = booking_db.BookingDB(filename)
+    assert db.migrate() == len(booking_db.MIGRATIONS)
+    assert db.migrate() == len(booking_db.MIGRATIONS)
+
+    with db._pool.connection() as conn:
+        indexes = {row['name'] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {'idx_event_person_date', 'idx_event_activity_date',
+            'ux_event_slot'} <= indexes
+    # The slot index leads with date, so a separate date index is redundant
+    assert 'idx_event_date' not in indexes
+    assert len(db.get_event_by_person(1)) == 1
+    assert db.get_event_by_id(1)['date'] == '2004-08-14'
+    assert db.get_event_by_id(1)['amount_cents'] == 40000
+    assert db.get_event_by_id(1)['currency'] == 'USD'
+    assert db.get_report('activity') == [
+        {'activity_id': 1, 'name': 'Birthday', 'currency': 'USD',
+         'count': 1, 'total_cents': 40000, 'total': 400.0}]
+    db.close()
+
+
+def test_person_pagination(test_client):
+    """
+    Tests keyset pagination of GET /api/person/ with limit and after_id
+    """
+    for name in ('Carl', 'Mrs. Smith', 'Emily'):
+        main_api.db.insert_person(name)
+
+    response = test_client.get('/api/person/?limit=2')
+    assert response.status_code == 200
+    response_json = json.loads(response.data)
+    assert [p['name'] for p in response_json['items']] == \
+        ['Carl', 'Mrs. Smith']
+    assert response_json['next'] == 2
+
+    response = test_client.get('/api/person/?limit=2&after_id=2')
+    response_json = json.loads(response.data)
+    assert [p['name'] for p in response_json['items']] == ['Emily']
+    assert response_json['next'] is None
+
+    response = test_client.get('/api/person/?limit=abc')
+    assert response.status_code == 422
+
+    response = test_client.get('/api/person/?after_id=' + str(2 ** 63))
+    assert response.status_code == 422
+
+
+def test_event_pagination(test_client):
+    """
+    Tests keyset pagination of GET /api/event/
+    """
+    main_api.db.insert_person('Carl')
+    main_api.db.insert_activity('Birthday')
+    for day in range(1, 4):
+        main_api.db.insert_event(1, 1, 'May-{}-2019'.format(day), 100.0)
+
+    response = test_client.get('/api/event/?limit=3')
+    response_json = json.loads(response.data)
+    assert [e['event_id'] for e in response_json['items']] == [1, 2, 3]
+    assert response_json['next'] is None
+
+    response = test_client.get('/api/event/?after_id=1')
+    response_json = json.loads(response.data)
+    assert [e['event_id'] for e in response_json['items']] == [2, 3]
+
+
+def test_export_events(test_client):
+    """
+    Tests the NDJSON and CSV streaming export of the event overview
+    """
+    main_api.db.insert_person('Carl')
+    main_api.db.insert_activity('Birthday')
+    main_api.db.insert_event(1, 1, 'Aug-14-2004', 400.0)
+    main_api.db.insert_event(1, 1, 'Aug-15-2004', 250.0)
+
+    response = test_client.get('/api/event/export')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    rows = [json.loads(line) for line in response.data.splitlines()]
+    assert rows == [
+        {'id': 1, 'person': 'Carl', 'activity': 'Birthday',
+         'date': '2004-08-14', 'amount': 400.0},
+        {'id': 2, 'person': 'Carl', 'activity': 'Birthday',
+         'date': '2004-08-15', 'amount': 250.0},
+    ]
+
+    response = test_client.get('/api/event/export?format=csv')
+    assert response.mimetype == 'text/csv'
+    lines = response.data.decode().splitlines()
+    assert lines[0] == 'id,person,activity,date,amount'
+    assert lines[2] == '2,Carl,Birthday,2004-08-15,250.0'
+
+    assert list(main_api.db.iter_overview(batch_size=1)) == \
+        main_api.db.overview()
+
+
+def test_bulk_insert_events(test_client):
+    """
+    Tests POST /api/event/bulk with a JSON array, including rejected rows
+    """
+    main_api.db.insert_person('Carl')
+    main_api.db.insert_activity('Birthday')
+
+    events = [
+        {'person_id': 1, 'activity_id': 1, 'date': 'May-1-2019',
+         'amount': 100.0},
+        {'person_id': 1, 'activity_id': 1, 'amount': 100.0},
+        {'person_id': 7, 'activity_id': 1, 'date': 'May-2-2019',
+         'amount': 100.0},
+        {'person_id': 1, 'activity_id': 1, 'date': 'May-3-2019',
+         'amount': '250.5'},
+    ]
+    response = test_client.post('/api/event/bulk', json=events)
+    assert response.status_code == 200
+    response_json = json.loads(response.data)
+
+    assert response_json['ids'] == [1, None, None, 2]
+    assert response_json['errors'] == [
+        {'index': 1, 'error': 'date required'},
+        {'index': 2, 'error': 'person not found'},
+    ]
+    assert main_api.db.get_event_by_id(2)['amount'] == 250.5
+
+
+def test_bulk_insert_events_ndjson(test_client):
+    """
+    Tests POST /api/event/bulk with a newline-delimited JSON body
+    """
+    main_api.db.insert_person('Carl')
+    main_api.db.insert_activity('Birthday')
+
+    body = '\n'.join(json.dumps({'person_id': 1, 'activity_id': 1,
+                                 'date': 'May-{}-2019'.format(day),
+                                 'amount': 10})
+                     for day in range(1, 6))
+    response = test_client.post('/api/event/bulk', data=body,
+                                content_type='application/x-ndjson')
+    response_json = json.loads(response.data)
+    assert response_json == {'ids': [1, 2, 3, 4, 5], 'errors': []}
+
+    response = test_client.post('/api/event/bulk', data='{}',
+                                content_type='application/json')
+    assert response.status_code == 422
+
+
+def test_bulk_import_people(test_client):
+    """
+    Tests POST /api/person/bulk upserts by name and returns the id mapping
+    """
+    main_api.db.insert_person('Carl')
+
+    response = test_client.post('/api/person/bulk',
+                                json=['Mrs. Smith', 'Carl',
+                                      {'name': 'Emily'}, 'Mrs. Smith'])
+    assert response.status_code == 200
+    response_json = json.loads(response.data)
+    assert response_json == {'Carl': 1, 'Mrs. Smith': 2, 'Emily': 3}
+    assert len(main_api.db.get_all_people()) == 3
+
+    response = test_client.post('/api/person/bulk', json=['Carl', ''])
+    assert response.status_code == 422
+
+
+def test_bulk_import_activities(test_client):
+    """
+    Tests POST /api/activity/bulk and that single inserts reuse names
+    """
+    response = test_client.post('/api/activity/bulk',
+                                json=['Birthday', 'Wedding'])
+    assert json.loads(response.data) == {'Birthday': 1, 'Wedding': 2}
+
+    response = test_client.post('/api/activity/', data={'name': 'Wedding'})
+    assert json.loads(response.data) == {'activity_id': 2, 'name': 'Wedding'}
+    assert len(main_api.db.get_all_activities()) == 2
+
+
+def test_migrate_merges_duplicate_names(tmp_path):
+    """
+    Tests that migrating merges duplicate people and repoints their events
+    """
+    filename = str(tmp_path / 'dupes.sqlite')
+    conn = sqlite3.connect(filename)
+    conn.execute('CREATE TABLE person(person_id INTEGER PRIMARY KEY, '
+                 'name TEXT)')
+    conn.execute('CREATE TABLE activity(activity_id INTEGER PRIMARY KEY, '
+                 'name TEXT)')
+    conn.execute('CREATE TABLE event(event_id INTEGER PRIMARY KEY, '
+                 'person_id INTEGER, activity_id INTEGER, date TEXT, '
+                 'amount FLOAT)')
+    conn.executemany('INSERT INTO person(name) VALUES(?)',
+                     [('Carl',), ('Emily',), ('Carl',)])
+    conn.execute("INSERT INTO activity(name) VALUES('Birthday')")
+    conn.execute("INSERT INTO event(person_id, activity_id, date, amount) "
+                 "VALUES(3, 1, 'Aug-14-2004', 400.0)")
+    conn.commit()
+    conn.close()
+
+    db = booking_db.BookingDB(filename)
+    db.migrate()
+    assert db.get_all_people() == [{'person_id': 1, 'name': 'Carl'},
+                                   {'person_id': 2, 'name': 'Emily'}]
+    assert db.get_event_by_id(1)['person_id'] == 1
+    db.close()
+
+
+def test_same_day_conflict(test_client):
+    """
+    Tests that POST /api/event/ returns 409 for a date that is already booked
+    and that bulk bookings report the same conflict per row
+    """
+    main_api.db.import_people(['Carl', 'Mrs. Smith'])
+    main_api.db.import_activities(['Birthday', 'Wedding'])
+
+    event = {'person_id': 1, 'activity_id': 1, 'date': 'Aug-14-2004',
+             'amount': 400.00}
+    response = test_client.post('/api/event/', data=event)
+    assert response.status_code == 200
+
+    event = {'person_id': 2, 'activity_id': 2, 'date': 'Aug-14-2004',
+             'amount': 1600.00}
+    response = test_client.post('/api/event/', data=event)
+    assert response.status_code == 409
+
+    events = [
+        {'person_id': 2, 'activity_id': 2, 'date': 'Aug-14-2004',
+         'amount': 1},
+        {'person_id': 2, 'activity_id': 2, 'date': 'Aug-15-2004',
+         'amount': 1},
+        {'person_id': 1, 'activity_id': 1, 'date': 'Aug-15-2004',
+         'amount': 1},
+    ]
+    response = test_client.post('/api/event/bulk', json=events)
+    response_json = json.loads(response.data)
+    assert response_json['ids'] == [None, 2, None]
+    assert [e['index'] for e in response_json['errors']] == [0, 2]
+
+
+def test_activity_conflict_scope(tmp_path):
+    """
+    Tests that the activity conflict scope allows different activities on the
+    same date and that switching scope rebuilds the unique index
+    """
+    filename = str(tmp_path / 'scope.sqlite')
+    db = booking_db.BookingDB(filename, conflict_scope='activity')
+    db.create_tables()
+    db.import_people(['Carl'])
+    db.import_activities(['Birthday', 'Wedding'])
+
+    db.insert_event(1, 1, 'Aug-14-2004', 400.0)
+    db.insert_event(1, 2, 'Aug-14-2004', 400.0)
+    with pytest.raises(booking_db.BookingConflict):
+        db.insert_event(1, 2, 'Aug-14-2004', 400.0)
+    db.close()
+
+    db = booking_db.BookingDB(filename, conflict_scope='date')
+    with pytest.raises(booking_db.BookingConflict):
+        db.migrate()
+    db.close()
+
+
+def test_normalize_date():
+    """
+    Tests that the accepted date formats are stored as ISO-8601
+    """
+    for value in ('May-24-2019', ' May-24-2019 ', '2019-05-24',
+                  '05/24/2019', '05-24-2019'):
+        assert booking_db.normalize_date(value) == '2019-05-24'
+    assert booking_db.normalize_date('Nov-1-2007') == '2007-11-01'
+    assert booking_db.normalize_date('November-1-2007') == '2007-11-01'
+
+    with pytest.raises(ValueError):
+        booking_db.normalize_date('someday')
+
+
+def test_event_date_range_and_calendar(test_client):
+    """
+    Tests the from/to range filter on GET /api/event/ and the month calendar
+    """
+    main_api.db.insert_person('Carl')
+    main_api.db.import_activities(['Birthday', 'Wedding'])
+    main_api.db.insert_event(1, 1, 'May-24-2019', 100.0)
+    main_api.db.insert_event(1, 1, '2019-05-02', 100.0)
+    main_api.db.insert_event(1, 2, '06/01/2019', 100.0)
+
+    response = test_client.get('/api/event/?from=May-1-2019&to=2019-05-31')
+    assert response.status_code == 200
+    response_json = json.loads(response.data)
+    assert [e['date'] for e in response_json] == ['2019-05-02', '2019-05-24']
+
+    response = test_client.get('/api/event/?from=2019-05-03')
+    assert [e['event_id'] for e in json.loads(response.data)] == [1, 3]
+
+    response = test_client.get('/api/event/?from=whenever')
+    assert response.status_code == 422
+
+    for query in ('limit=1', 'after_id=1', 'format=columns', 'ids=1'):
+        response = test_client.get('/api/event/?from=2019-05-03&' + query)
+        assert response.status_code == 422
+
+    response = test_client.get('/api/calendar/2019/5')
+    assert response.status_code == 200
+    response_json = json.loads(response.data)
+    assert len(response_json['days']) == 31
+    assert response_json['days'][1] == {'date': '2019-05-02', 'events': 1}
+    assert response_json['days'][23] == {'date': '2019-05-24', 'events': 1}
+    assert sum(day['events'] for day in response_json['days']) == 2
+
+    response = test_client.get('/api/calendar/2019/13')
+    assert response.status_code == 404
+
+
+def test_lru_cache_bounds():
+    """
+    Tests LRU eviction, TTL expiry and tag invalidation of the read cache
+    """
+    now = [0.0]
+    cache = booking_db.LRUCache(maxsize=2, ttl=10, clock=lambda: now[0])
+
+    for key in ('a', 'b', 'c'):
+        cache.put(key, key.upper(), ('person',), cache.generation(('person',)))
+    assert cache.get('a') == (False, None)
+    assert cache.get('c') == (True, 'C')
+
+    now[0] = 11.0
+    assert cache.get('c') == (False, None)
+
+    generation = cache.generation(('event',))
+    cache.invalidate(('event',))
+    cache.put('d', 'D', ('event',), generation)
+    assert cache.get('d') == (False, None)
+
+    cache.put('e', 'E', ('event',), cache.generation(('event',)))
+    cache.invalidate(('person',))
+    assert cache.get('e') == (True, 'E')
+    cache.invalidate(('event',))
+    assert cache.get('e') == (False, None)
+
+
+def test_read_cache_invalidation(tmp_path):
+    """
+    Tests that BookingDB serves repeated reads from the cache and that
+    writes invalidate them
+    """
+    db = booking_db.BookingDB(str(tmp_path / 'cache.sqlite'))
+    db.create_tables()
+    db.insert_person('Carl')
+
+    assert db.get_all_people() == [{'person_id': 1, 'name': 'Carl'}]
+    assert db.get_all_people() == [{'person_id': 1, 'name': 'Carl'}]
+    info = db.cache_info()
+    assert (info['hits'], info['misses']) == (1, 1)
+
+    db.insert_person('Emily')
+    assert len(db.get_all_people()) == 2
+    assert db.cache_info()['misses'] == 2
+
+    db.import_activities(['Birthday'])
+    db.insert_event(1, 1, '2019-05-24', 10.0)
+    assert len(db.overview()) == 1
+    hits = db.cache_info()['hits']
+    report = db.get_report('day', date_from='2019-05-01')
+    assert len(report) == 1
+    assert db.get_report('day', date_from='2019-05-01') == report
+    assert db.get_report('day', date_to='2019-05-01') == []
+    assert db.search_people('emily', limit=1) == \
+        [{'person_id': 2, 'name': 'Emily'}]
+    assert db.cache_info()['hits'] == hits + 1
+    db.delete_event(1)
+    assert db.overview() == []
+    db.close()
+
+    db = booking_db.BookingDB(str(tmp_path / 'cache.sqlite'), cache_size=0)
+    assert db.cache_info() is None
+    assert len(db.get_all_people()) == 2
+    db.close()
+
+
+def test_conditional_get(test_client):
+    """
+    Tests ETag and If-None-Match handling driven by the table versions
+    """
+    main_api.db.insert_person('Carl')
+
+    response = test_client.get('/api/person/')
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+
+    response = test_client.get('/api/person/',
+                               headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.headers['Vary'] == 'Accept-Encoding'
+
+    response = test_client.get('/api/activity/',
+                               headers={'If-None-Match': etag})
+    assert response.status_code == 200
+
+    main_api.db.insert_person('Emily')
+    response = test_client.get('/api/person/',
+                               headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert len(json.loads(response.data)) == 2
+
+
+def test_last_modified(test_client, monkeypatch):
+    """
+    Tests that Last-Modified is only used once the second of the last write
+    is over, and that If-None-Match decides when both are sent
+    """
+    main_api.db.insert_person('Carl')
+    modified = main_api.db.table_versions('person')['person'][1]
+    since = datetime.datetime.fromtimestamp(
+        modified, datetime.timezone.utc).strftime('%a, %d %b %Y %H:%M:%S GMT')
+
+    # Another write may still land in this second
+    monkeypatch.setattr(main_api.time, 'time', lambda: modified + 0.5)
+    response = test_client.get('/api/person/')
+    assert 'Last-Modified' not in response.headers
+    response = test_client.get('/api/person/',
+                               headers={'If-Modified-Since': since})
+    assert response.status_code == 200
+
+    monkeypatch.setattr(main_api.time, 'time', lambda: modified + 1.5)
+    response = test_client.get('/api/person/')
+    assert response.headers['Last-Modified'] == since
+    response = test_client.get('/api/person/',
+                               headers={'If-Modified-Since': since})
+    assert response.status_code == 304
+
+    response = test_client.get('/api/person/',
+                               headers={'If-Modified-Since': since,
+                                        'If-None-Match': '"person.1"'})
+    assert response.status_code == 200
+
+
+def test_table_versions(tmp_path):
+    """
+    Tests that table versions change on every write and survive
+    re-creating the tables
+    """
+    db = booking_db.BookingDB(str(tmp_path / 'versions.sqlite'))
+    db.create_tables()
+    before = db.table_versions('person', 'event')
+
+    db.import_people(['Carl', 'Emily'])
+    after = db.table_versions('person', 'event')
+    assert after['person'][0] > before['person'][0]
+    assert after['event'] == before['event']
+
+    db.create_tables()
+    assert db.table_versions('person')['person'][0] > after['person'][0]
+    db.close()
+
+
+def test_columns_format(test_client):
+    """
+    Tests the compact columnar layout of GET /api/person/?format=columns
+    """
+    main_api.db.import_people(['Carl', 'Emily'])
+
+    response = test_client.get('/api/person/?format=columns')
+    assert response.status_code == 200
+    assert json.loads(response.data) == {
+        'columns': ['person_id', 'name'],
+        'rows': [[1, 'Carl'], [2, 'Emily']],
+    }
+
+
+def test_gzip_compression(test_client):
+    """
+    Tests that large API responses are gzip-compressed when accepted, and
+    that the compressed ETag still answers conditional requests
+    """
+    main_api.db.import_people(['Person {}'.format(i) for i in range(200)])
+
+    response = test_client.get('/api/person/')
+    assert 'Content-Encoding' not in response.headers
+
+    response = test_client.get('/api/person/',
+                               headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    people = json.loads(gzip.decompress(response.data))
+    assert len(people) == 200
+
+    etag = response.headers['ETag']
+    assert etag.endswith('-gzip"')
+    response = test_client.get('/api/person/',
+                               headers={'Accept-Encoding': 'gzip',
+                                        'If-None-Match': etag})
+    assert response.status_code == 304
+
+    response = test_client.get('/api/person/1',
+                               headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+
+
+def test_query_profiler(tmp_path, caplog):
+    """
+    Tests that a profiling BookingDB counts statements and logs slow ones
+    """
+    db = booking_db.BookingDB(str(tmp_path / 'profile.sqlite'), profile=True,
+                              slow_query_ms=0, cache_size=0)
+    db.create_tables()
+    db.import_people(['Carl'])
+
+    db.profiler.begin()
+    with caplog.at_level('WARNING', logger='booking_db'):
+        db.get_all_people()
+        db.get_all_people()
+    count, seconds = db.profiler.end()
+    assert count == 2
+    assert seconds > 0
+
+    stats = db.profiler.stats()
+    assert stats['SELECT * FROM person']['count'] == 2
+    assert 'slow query' in caplog.text
+    db.close()
+
+
+def test_server_timing(test_client, tmp_path, monkeypatch):
+    """
+    Tests the Server-Timing header added when PROFILE is on
+    """
+    db = booking_db.BookingDB(str(tmp_path / 'timing.sqlite'), profile=True,
+                              cache_size=0)
+    db.create_tables()
+    monkeypatch.setattr(main_api, 'db', db)
+    monkeypatch.setitem(main_api.app.config, 'PROFILE', True)
+
+    response = test_client.get('/api/person/')
+    assert response.status_code == 200
+    timing = response.headers['Server-Timing']
+    assert timing.startswith('db;dur=')
+    assert 'desc="3 queries"' in timing
+    # The table versions are now held in memory, and only checked with
+    # PRAGMA data_version
+    timing = test_client.get('/api/person/').headers['Server-Timing']
+    assert 'desc="2 queries"' in timing
+    db.close()
+
+    monkeypatch.setitem(main_api.app.config, 'PROFILE', False)
+    response = test_client.get('/api/person/')
+    assert 'Server-Timing' not in response.headers
+
+
+def test_metrics_registry():
+    """
+    Tests the text exposition of counters and histograms
+    """
+    registry = metrics.Registry()
+    counter = registry.counter('jobs_total', 'Jobs run', ('kind',))
+    histogram = registry.histogram('job_seconds', 'Job time', ('kind',),
+                                   buckets=(0.1, 1.0))
+    counter.inc(('import',))
+    counter.inc(('import',), 2)
+    histogram.observe(('import',), 0.05)
+    histogram.observe(('import',), 0.5)
+    histogram.observe(('import',), 5)
+
+    lines = registry.render().splitlines()
+    assert '# TYPE jobs_total counter' in lines
+    assert 'jobs_total{kind="import"} 3' in lines
+    assert 'job_seconds_bucket{kind="import",le="0.1"} 1' in lines
+    assert 'job_seconds_bucket{kind="import",le="1"} 2' in lines
+    assert 'job_seconds_bucket{kind="import",le="+Inf"} 3' in lines
+    assert 'job_seconds_sum{kind="import"} 5.55' in lines
+    assert 'job_seconds_count{kind="import"} 3' in lines
+
+
+def test_metrics_endpoint(test_client):
+    """
+    Tests that /metrics reports requests, BookingDB methods, the pool and
+    the cache
+    """
+    main_api.db.insert_person('Carl')
+    test_client.get('/api/person/')
+    test_client.get('/api/person/1')
+
+    response = test_client.get('/metrics')
+    assert response.status_code == 200
+    text = response.data.decode()
+    assert 'http_requests_total{method="GET",route="/api/person/",' \
+        'status="200"}' in text
+    assert 'http_request_duration_seconds_count{method="GET",' \
+        'route="/api/person/<int:person_id>"}' in text
+    assert 'booking_db_method_duration_seconds_count{' \
+        'method="get_all_people"}' in text
+    assert 'booking_db_pool_connections{state="size"} 5' in text
+    assert 'booking_db_cache_lookups_total{result="miss"}' in text
+
+
+def test_reports(test_client):
+    """
+    Tests the /api/report/ endpoints as events are booked and deleted
+    """
+    main_api.db.import_people(['Carl', 'Emily'])
+    main_api.db.import_activities(['Birthday', 'Wedding'])
+    main_api.db.insert_events([
+        (1, 1, '2019-05-01', 100.0),
+        (1, 2, '2019-05-02', 250.5),
+        (2, 2, '2019-06-01', 1000.0),
+    ])
+
+    response = test_client.get('/api/report/activity')
+    assert response.status_code == 200
+    assert json.loads(response.data) == [
+        {'activity_id': 1, 'name': 'Birthday', 'currency': 'USD',
+         'count': 1, 'total_cents': 10000, 'total': 100.0},
+        {'activity_id': 2, 'name': 'Wedding', 'currency': 'USD',
+         'count': 2, 'total_cents': 125050, 'total': 1250.5},
+    ]
+
+    response = test_client.get('/api/report/month')
+    assert json.loads(response.data) == [
+        {'month': '2019-05', 'currency': 'USD', 'count': 2,
+         'total_cents': 35050, 'total': 350.5},
+        {'month': '2019-06', 'currency': 'USD', 'count': 1,
+         'total_cents': 100000, 'total': 1000.0},
+    ]
+
+    main_api.db.delete_event(1)
+    response = test_client.get('/api/report/person')
+    assert json.loads(response.data) == [
+        {'person_id': 1, 'name': 'Carl', 'currency': 'USD', 'count': 1,
+         'total_cents': 25050, 'total': 250.5},
+        {'person_id': 2, 'name': 'Emily', 'currency': 'USD', 'count': 1,
+         'total_cents': 100000, 'total': 1000.0},
+    ]
+
+    response = test_client.get(
+        '/api/report/day?from=2019-05-01&to=May-31-2019')
+    assert json.loads(response.data) == [
+        {'date': '2019-05-02', 'currency': 'USD', 'count': 1,
+         'total_cents': 25050, 'total': 250.5},
+    ]
+
+    assert test_client.get('/api/report/year').status_code == 404
+
+
+def test_exact_cents(test_client):
+    """
+    Tests that amounts are stored as integer cents, so totals are exact,
+    and that amounts in other currencies are reported separately
+    """
+    assert booking_db.to_cents('19.99') == 1999
+    assert booking_db.to_cents(0.1) == 10
+    assert booking_db.to_cents(2.675) == 268
+    with pytest.raises(ValueError):
+        booking_db.to_cents('ten')
+    for amount in ('1e30', '1e20', -2 ** 62):
+        with pytest.raises(ValueError):
+            booking_db.to_cents(amount)
+    with pytest.raises(ValueError):
+        booking_db.normalize_currency('dollars')
+
+    main_api.db.import_people(['Carl'])
+    main_api.db.import_activities(['Birthday'])
+    ids, errors = main_api.db.insert_events(
+        [(1, 1, datetime.date(2019, 5, 1) + datetime.timedelta(days=day),
+          0.1) for day in range(10)] +
+        [(1, 1, '2019-06-01', '5.00', 'eur'), (1, 1, '2019-06-02', 'x')])
+    assert errors == {11: "invalid amount: 'x'"}
+    assert main_api.db.get_event_by_id(11)['currency'] == 'EUR'
+
+    assert main_api.db.get_report('activity') == [
+        {'activity_id': 1, 'name': 'Birthday', 'currency': 'EUR',
+         'count': 1, 'total_cents': 500, 'total': 5.0},
+        {'activity_id': 1, 'name': 'Birthday', 'currency': 'USD',
+         'count': 10, 'total_cents': 100, 'total': 1.0},
+    ]
+
+    response = test_client.post('/api/event/bulk', data=json.dumps([
+        {'person_id': 1, 'activity_id': 1, 'date': '2019-07-01',
+         'amount': 1, 'currency': 'US'}]), content_type='application/json')
+    assert json.loads(response.data)['errors'] == [
+        {'index': 0, 'error': "invalid currency: 'US'"}]
+
+    # Amounts too large for an INTEGER column are refused, not a 500
+    for amount in ('1e30', '1e20'):
+        assert test_client.post('/api/event/', data={
+            'person_id': 1, 'activity_id': 1, 'date': '2019-08-01',
+            'amount': amount}).status_code == 422
+        assert test_client.patch('/api/event/1/', data={
+            'amount': amount}).status_code == 422
+        response = test_client.post('/api/event/bulk', data=json.dumps([
+            {'person_id': 1, 'activity_id': 1, 'date': '2019-08-01',
+             'amount': amount}]), content_type='application/json')
+        assert json.loads(response.data)['errors'] == [
+            {'index': 0, 'error': 'amount out of range: ' + repr(amount)}]
+
+
+@pytest.mark.parametrize('vectorized', [True, False])
+def test_event_columns(test_client, monkeypatch, vectorized):
+    """
+    Tests the columnar analytics with and without NumPy
+    """
+    if not vectorized:
+        monkeypatch.setattr(analytics, 'numpy', None)
+    elif analytics.numpy is None:
+        pytest.skip('NumPy is not installed')
+
+    main_api.db.import_people(['Carl'])
+    main_api.db.import_activities(['Birthday', 'Wedding'])
+    main_api.db.insert_events([
+        (1, 1, '2019-05-01', 10.0),
+        (1, 2, '2019-05-02', 20.5),
+        (1, 1, '2019-05-30', 30.0),
+        (1, 2, '2019-06-01', 40.0),
+        (1, 1, '2019-06-02', 7.0, 'EUR'),
+    ])
+
+    columns = main_api.db.load_event_columns()
+    assert len(columns) == 4
+    assert columns.total_cents() == 10050
+    assert columns.mean_cents() == 2512.5
+    assert columns.percentile_cents(50) == 2050
+    assert columns.percentile_cents(100) == 4000
+    assert columns.percentile_cents(0) == 1000
+    assert columns.histogram([0, 2000, 4000]) == [1, 3]
+    assert columns.totals_by_activity() == {1: (2, 4000), 2: (2, 6050)}
+    assert columns.totals_by_month() == {'2019-05': (3, 6050),
+                                         '2019-06': (1, 4000)}
+
+    columns = main_api.db.load_event_columns('2019-05-02', 'May-31-2019')
+    assert columns.total_cents() == 5050
+    assert analytics.day_number('2019-05-02') in columns.days
+
+    columns = main_api.db.load_event_columns(currency='EUR')
+    assert columns.totals_by_activity() == {1: (1, 700)}
+
+    columns = main_api.db.load_event_columns('2020-01-01')
+    assert columns.total_cents() == 0
+    assert columns.percentile_cents(50) is None
+    assert columns.totals_by_activity() == {}
+
+
+def asgi_request(app, method, path, body=b'', headers=()):
+    """
+    Prepares one request to an ASGI application, sending the body in two
+    chunks
+    :return: (run, response) where run is a coroutine function sending the
+    request and response a dict filled with its status, headers and body
+    """
+    path, _, query = path.partition('?')
+    scope = {'type': 'http', 'method': method, 'path': path,
+             'query_string': query.encode(), 'headers': list(headers)}
+    messages = [{'type': 'http.request', 'body': body[:5],
+                 'more_body': True},
+                {'type': 'http.request', 'body': body[5:]}]
+    response = {'body': b''}
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+            response['headers'] = dict(message['headers'])
+        else:
+            response['body'] += message.get('body', b'')
+
+    async def run():
+        await app(scope, receive, send)
+    return run, response
+
+
+def test_asgi_app(test_client):
+    """
+    Tests that the routes behave the same under the ASGI entry point
+    """
+    def call(method, path, body=b'', headers=()):
+        run, response = asgi_request(asgi.app, method, path, body, headers)
+        asyncio.run(run())
+        return response
+
+    response = call('POST', '/api/person/bulk', json.dumps(
+        ['Carl', 'Emily']).encode(),
+        [(b'content-type', b'application/json')])
+    assert response['status'] == 200
+    main_api.db.import_activities(['Birthday'])
+    response = call('POST', '/api/event/', b'person_id=1&activity_id=1&'
+                    b'date=2019-05-01&amount=10.5',
+                    [(b'content-type', b'application/x-www-form-urlencoded')])
+    assert response['status'] == 200
+    assert json.loads(response['body'])['amount_cents'] == 1050
+
+    response = call('GET', '/api/person/?limit=1')
+    assert response['status'] == 200
+    assert json.loads(response['body']) == json.loads(
+        test_client.get('/api/person/?limit=1').data)
+
+    response = call('GET', '/api/event/export?format=csv')
+    assert response['body'].decode().splitlines()[1] == \
+        '1,Carl,Birthday,2019-05-01,10.5'
+
+
+def test_asgi_overload(test_client):
+    """
+    Tests that requests beyond the thread pool and its queue get 503 while
+    the accepted ones are served
+    """
+    app = asgi.AsyncApp(main_api.app, max_workers=2, max_queued=1)
+    calls = [asgi_request(app, 'GET', '/api/person/') for _ in range(6)]
+
+    async def run_all():
+        await asyncio.gather(*(run() for run, _ in calls))
+    asyncio.run(run_all())
+
+    statuses = [response['status'] for _, response in calls]
+    assert statuses == [200, 200, 200, 503, 503, 503]
+    assert app.in_flight == 0
+
+
+def test_asgi_streams():
+    """
+    Tests that streamed bodies are read off the request threads, so a
+    request can be served while every request thread's stream is pending
+    """
+    served = threading.Event()
+
+    def wsgi_app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        if environ['PATH_INFO'] == '/quick':
+            served.set()
+            return [b'quick']
+
+        def stream():
+            yield b'first,'
+            yield b'rest' if served.wait(5) else b'stuck'
+        return stream()
+
+    app = asgi.AsyncApp(wsgi_app, max_workers=1, max_queued=1)
+    stream_run, stream = asgi_request(app, 'GET', '/stream')
+    quick_run, quick = asgi_request(app, 'GET', '/quick')
+
+    async def run_all():
+        streaming = asyncio.ensure_future(stream_run())
+        while not stream['body']:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        await quick_run()
+        await streaming
+    asyncio.run(run_all())
+
+    assert stream['body'] == b'first,rest'
+    assert quick['body'] == b'quick'
+    assert app.in_flight == 0
+
+
+def test_pool_timeout(test_client, monkeypatch):
+    """
+    Tests that a request answers 503 when no pooled connection frees up in
+    time
+    """
+    monkeypatch.setitem(main_api.app.config, 'DB_POOL_SIZE', 1)
+    monkeypatch.setitem(main_api.app.config, 'DB_POOL_TIMEOUT', 0.05)
+    main_api.close_db()
+    main_api.init_db()
+
+    held = main_api.get_db()._pool.acquire()
+    response = test_client.get('/api/person/')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    assert json.loads(response.data) == {'error': 'server busy'}
+
+    main_api.get_db()._pool.release(held)
+    assert test_client.get('/api/person/').status_code == 200
+
+
+def test_group_commit(tmp_path):
+    """
+    Tests that concurrent inserts through the group commit writer are
+    batched, that each gets its own id or conflict, and that a conflict does
+    not roll back the rest of its batch
+    """
+    db = booking_db.BookingDB(str(tmp_path / 'group.sqlite'),
+                              group_commit=True, group_commit_ms=50)
+    db.create_tables()
+    db.import_people(['Carl'])
+    db.import_activities(['Birthday'])
+
+    results = {}
+    barrier = threading.Barrier(20)
+
+    def book(index):
+        barrier.wait()
+        try:
+            results[index] = db.insert_event(
+                1, 1, datetime.date(2019, 5, 1 + index % 10), 10)
+        except booking_db.BookingConflict as e:
+            results[index] = e
+
+    threads = [threading.Thread(target=book, args=(index,))
+               for index in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    ids = [result for result in results.values() if isinstance(result, int)]
+    assert sorted(ids) == list(range(1, 11))
+    assert len(results) - len(ids) == 10
+    assert len(db.get_all_events()) == 10
+    stats = db.write_stats()
+    assert stats['writes'] == 20
+    assert stats['batches'] < 20
+    assert stats['queued'] == 0
+
+    db.delete_event(ids[0])
+    assert len(db.get_all_events()) == 9
+    db.close()
+
+    db = booking_db.BookingDB(str(tmp_path / 'group.sqlite'))
+    assert len(db.get_all_events()) == 9
+    assert db.write_stats() is None
+    db.close()
+
+
+def test_search(test_client):
+    """
+    Tests typeahead search of people and activities by name prefix
+    """
+    main_api.db.import_people(['Carl Sagan', 'Carla Bruni', 'Emily Carr',
+                               'Émile Zola', 'Bob'])
+    main_api.db.import_activities(['Birthday', 'Bridal shower'])
+
+    response = test_client.get('/api/person/?q=car')
+    assert response.status_code == 200
+    assert [person['name'] for person in json.loads(response.data)] == [
+        'Carl Sagan', 'Carla Bruni', 'Emily Carr']
+
+    response = test_client.get('/api/person/?q=car&limit=1')
+    assert len(json.loads(response.data)) == 1
+
+    response = test_client.get('/api/person/?q=sagan+car')
+    assert json.loads(response.data) == [
+        {'person_id': 1, 'name': 'Carl Sagan'}]
+
+    response = test_client.get('/api/person/?q=emile')
+    assert json.loads(response.data) == [
+        {'person_id': 4, 'name': 'Émile Zola'}]
+
+    assert json.loads(test_client.get('/api/person/?q=').data) == []
+    assert json.loads(test_client.get('/api/person/?q="OR(').data) == []
+    assert test_client.get('/api/person/?q=a&limit=x').status_code == 422
+
+    main_api.db.delete_person(1)
+    main_api.db.insert_person('Carlos Santana')
+    response = test_client.get('/api/person/?q=car')
+    assert {person['name'] for person in json.loads(response.data)} == {
+        'Carla Bruni', 'Emily Carr', 'Carlos Santana'}
+
+    response = test_client.get('/api/activity/?q=b')
+    assert [activity['name'] for activity in json.loads(response.data)] == [
+        'Birthday', 'Bridal shower']
+    response = test_client.get('/api/activity/?q=sho')
+    assert json.loads(response.data) == [
+        {'activity_id': 2, 'name': 'Bridal shower'}]
+
+
+def test_paginated_pages(test_client, monkeypatch):
+    """
+    Tests that the /event, /person and /activity pages render one sorted
+    keyset page at a time, and that rendered tables are cached until one of
+    the tables they show is written to
+    """
+    monkeypatch.setattr(main_api.app, 'jinja_loader',
+                        jinja2.FileSystemLoader(main_api.app.root_path))
+    main_api.db.import_people(['Carl', 'Emily', 'Ann'])
+    main_api.db.import_activities(['Birthday'])
+    main_api.db.insert_events([
+        (1, 1, '2019-05-03', 10), (2, 1, '2019-05-01', 20),
+        (3, 1, '2019-05-02', 30)])
+
+    response = test_client.get('/event?limit=2')
+    assert response.status_code == 200
+    page = response.data.decode()
+    assert '<td>Carl</td>' in page and '<td>Emily</td>' in page
+    assert '<td>Ann</td>' not in page
+    assert 'after_id=2' in page
+
+    response = test_client.get('/event?sort=date&limit=2')
+    page = response.data.decode()
+    assert page.index('2019-05-01') < page.index('2019-05-02')
+    assert 'after=2019-05-02' in page and 'after_id=3' in page
+    page = test_client.get(
+        '/event?sort=date&limit=2&after=2019-05-02&after_id=3').data.decode()
+    assert '2019-05-03' in page and '2019-05-01' not in page
+    assert 'Next' not in page
+
+    page = test_client.get('/person?sort=name&order=desc').data.decode()
+    assert page.index('Emily') < page.index('Carl') < page.index('Ann')
+    page = test_client.get('/activity').data.decode()
+    assert '<td>Birthday</td>' in page
+
+    hits = main_api.get_fragments().info()['hits']
+    test_client.get('/person?sort=name&order=desc')
+    assert main_api.get_fragments().info()['hits'] == hits + 1
+    main_api.db.insert_person('Bob')
+    page = test_client.get('/person?sort=name&order=desc').data.decode()
+    assert main_api.get_fragments().info()['hits'] == hits + 1
+    assert page.index('Carl') < page.index('Bob') < page.index('Ann')
+
+    page = test_client.get(
+        '/person?sort=name&limit=1&after=Ann&after_id=3').data.decode()
+    assert '<td>Bob</td>' in page and '<td>Ann</td>' not in page
+    # Without the name the cursor cannot be placed in name order
+    assert test_client.get(
+        '/person?sort=name&limit=1&after_id=3').status_code == 422
+
+    assert test_client.get('/event?sort=amount').status_code == 422
+    assert test_client.get('/person?order=up').status_code == 422
+
+
+def test_page_cache_per_database(test_client, tmp_path, monkeypatch):
+    """
+    Tests that a page rendered from one database file is not served from
+    another with the same table versions
+    """
+    monkeypatch.setattr(main_api.app, 'jinja_loader',
+                        jinja2.FileSystemLoader(main_api.app.root_path))
+    for name in ('Carl', 'Emily'):
+        monkeypatch.setitem(main_api.app.config, 'DATABASE',
+                            str(tmp_path / (name + '.sqlite')))
+        main_api.close_db()
+        main_api.init_db()
+        main_api.db.insert_person(name)
+        page = test_client.get('/person').data.decode()
+        assert '<td>{}</td>'.format(name) in page
+    assert '<td>Carl</td>' not in page
+    main_api.close_db()
+
+
+def test_create_app_derived_settings(test_client, monkeypatch):
+    """
+    Tests that the worker count and the page cache follow the config given
+    to create_app rather than the one at import
+    """
+    for key in ('DB_POOL_SIZE', 'ASYNC_WORKERS', 'FRAGMENT_CACHE_SIZE'):
+        monkeypatch.setitem(main_api.app.config, key,
+                            main_api.app.config[key])
+    main_api.get_fragments()
+
+    app = main_api.create_app({'DB_POOL_SIZE': 3, 'ASYNC_WORKERS': None,
+                               'FRAGMENT_CACHE_SIZE': 7})
+    assert app.config['ASYNC_WORKERS'] == 3
+    assert main_api.get_fragments().info()['maxsize'] == 7
+
+    main_api.create_app({'ASYNC_WORKERS': 2})
+    assert app.config['ASYNC_WORKERS'] == 2
+    main_api.close_db()
+
+
+def test_event_details_and_multi_get(test_client):
+    """
+    Tests that events by id carry their person and activity names, that
+    missing ids give 404, and the ?ids= multi-get of every resource
+    """
+    main_api.db.import_people(['Carl', 'Emily'])
+    main_api.db.import_activities(['Birthday', 'Wedding'])
+    main_api.db.insert_events([(1, 2, '2019-05-01', 10),
+                               (2, 1, '2019-05-02', 20),
+                               (2, 2, '2019-05-03', 30)])
+
+    response = test_client.get('/api/event/2/')
+    assert response.status_code == 200
+    event = json.loads(response.data)
+    assert (event['person'], event['activity']) == ('Emily', 'Birthday')
+    assert (event['person_id'], event['activity_id']) == (2, 1)
+
+    assert test_client.get('/api/event/9/').status_code == 404
+    assert test_client.get('/api/person/9').status_code == 404
+    assert test_client.get('/api/activity/9').status_code == 404
+
+    response = test_client.get('/api/event/?ids=3,1,9,3')
+    events = json.loads(response.data)
+    assert [event['event_id'] for event in events] == [3, 1]
+    assert [event['person'] for event in events] == ['Emily', 'Carl']
+
+    response = test_client.get('/api/person/?ids=2,1')
+    assert json.loads(response.data) == [
+        {'person_id': 2, 'name': 'Emily'}, {'person_id': 1, 'name': 'Carl'}]
+    response = test_client.get('/api/activity/?ids=2')
+    assert json.loads(response.data) == [
+        {'activity_id': 2, 'name': 'Wedding'}]
+    assert json.loads(test_client.get('/api/event/?ids=').data) == []
+    assert test_client.get('/api/event/?ids=1,a').status_code == 422
+    assert test_client.get(
+        '/api/event/?ids=1,{}'.format(2 ** 63)).status_code == 422
+
+    assert len(main_api.db.get_events_by_ids(
+        list(range(1, 2 * booking_db.SQL_IN_CHUNK)))) == 3
+
+    # Events show person names, so a write to person changes their ETag
+    etag = test_client.get('/api/event/1/').headers['ETag']
+    main_api.db.insert_person('Ann')
+    response = test_client.get('/api/event/1/',
+                               headers={'If-None-Match': etag})
+    assert response.status_code == 200
+
+
+def test_batch_delete(test_client, monkeypatch):
+    """
+    Tests batch deletes with a JSON list of ids, single deletes by URL, and
+    restrict and cascade handling of people and activities with events
+    """
+    main_api.db.import_people(['Carl', 'Emily', 'Ann'])
+    main_api.db.import_activities(['Birthday', 'Wedding'])
+    main_api.db.insert_events([
+        (1, 1, datetime.date(2019, 5, 1) + datetime.timedelta(days=day), 10)
+        for day in range(600)] + [(2, 2, '2021-01-01', 20)])
+
+    response = test_client.delete('/api/event/', data=json.dumps(
+        list(range(1, 551)) + [9999]), content_type='application/json')
+    assert response.status_code == 200
+    deleted = json.loads(response.data)['deleted']
+    assert [event['event_id'] for event in deleted] == list(range(1, 551))
+    assert deleted[0]['amount'] == 10.0
+    assert len(main_api.db.get_all_events()) == 51
+
+    response = test_client.delete('/api/event/551/')
+    assert json.loads(response.data)['event_id'] == 551
+    assert test_client.delete('/api/event/551/').status_code == 404
+    assert test_client.delete('/api/event/', data=json.dumps(['a']),
+                              content_type='application/json') \
+        .status_code == 422
+    assert test_client.delete('/api/event/', data=json.dumps([2 ** 63]),
+                              content_type='application/json') \
+        .status_code == 422
+    assert test_client.delete('/api/event/', data={
+        'event_id': str(2 ** 63)}).status_code == 422
+
+    response = test_client.delete('/api/person/', data=json.dumps(
+        {'ids': [1, 3]}), content_type='application/json')
+    assert response.status_code == 409
+    assert main_api.db.get_person_by_id(3) is not None
+
+    response = test_client.delete('/api/person/3')
+    assert json.loads(response.data) == {'person_id': 3, 'name': 'Ann'}
+
+    people, events = main_api.db.delete_people([1], cascade=True)
+    assert people == [{'person_id': 1, 'name': 'Carl'}]
+    assert events == list(range(552, 601))
+    assert [event['person'] for event in main_api.db.overview()] == \
+        ['Emily']
+
+    monkeypatch.setattr(main_api.db, '_on_delete', 'cascade')
+    response = test_client.delete('/api/activity/', data=json.dumps([2]),
+                                  content_type='application/json')
+    assert json.loads(response.data) == {
+        'deleted': [{'activity_id': 2, 'name': 'Wedding'}],
+        'deleted_events': [601]}
+    assert main_api.db.get_all_events() == []
+
+
+def test_event_updates(test_client):
+    """
+    Tests PUT and PATCH of events, with If-Match versions guarding against
+    lost updates
+    """
+    main_api.db.import_people(['Carl', 'Emily'])
+    main_api.db.import_activities(['Birthday', 'Wedding'])
+    main_api.db.insert_events([(1, 1, '2019-05-01', 10),
+                               (2, 2, '2019-05-02', 20)])
+
+    response = test_client.patch('/api/event/1/', data={'amount': '12.5'})
+    assert response.status_code == 200
+    event = json.loads(response.data)
+    assert (event['amount'], event['version'], event['person']) == \
+        (12.5, 2, 'Carl')
+    assert response.headers['ETag'] == '"2"'
+
+    response = test_client.put('/api/event/1/', data=json.dumps({
+        'person_id': 2, 'activity_id': 2, 'date': 'May-24-2019',
+        'amount': 400, 'currency': 'eur'}), content_type='application/json',
+        headers={'If-Match': '"2"'})
+    assert response.status_code == 200
+    event = json.loads(response.data)
+    assert (event['person'], event['activity'], event['date'],
+            event['amount_cents'], event['currency'], event['version']) == \
+        ('Emily', 'Wedding', '2019-05-24', 40000, 'EUR', 3)
+
+    # A second client still holding version 2 must not overwrite version 3
+    response = test_client.patch('/api/event/1/', data={'amount': '1'},
+                                 headers={'If-Match': '"2"'})
+    assert response.status_code == 409
+    assert response.headers['ETag'] == '"3"'
+    assert main_api.db.get_event_by_id(1)['amount'] == 400.0
+
+    assert [(row['activity_id'], row['currency'], row['total_cents'])
+            for row in main_api.db.get_report('activity')] == [
+        (2, 'EUR', 40000), (2, 'USD', 2000)]
+    assert test_client.patch('/api/event/2/', data={'date': '2019-05-24'}) \
+        .status_code == 409
+    assert test_client.patch('/api/event/2/', data={'person_id': 9}) \
+        .status_code == 422
+    assert test_client.patch('/api/event/2/', data={'colour': 'red'}) \
+        .status_code == 422
+    for date in (None, 20200101, ''):
+        response = test_client.patch('/api/event/2/',
+                                     data=json.dumps({'date': date}),
+                                     content_type='application/json')
+        assert response.status_code == 422
+        assert json.loads(response.data) == \
+            {'error': 'date must be a non-empty string'}
+    with pytest.raises(ValueError):
+        main_api.db.update_event(2, {'date': 20200101})
+    assert test_client.put('/api/event/2/', data={'amount': 1}) \
+        .status_code == 422
+    assert test_client.patch('/api/event/9/', data={'amount': 1}) \
+        .status_code == 404
+    assert main_api.db.get_event_by_id(2)['version'] == 1
+
+    # The ETag of a GET of the event is accepted back in If-Match
+    response = test_client.get('/api/event/2/')
+    etag = response.headers['ETag']
+    assert etag.startswith('"1-')
+    assert test_client.get('/api/event/2/', headers={
+        'If-None-Match': etag}).status_code == 304
+    response = test_client.patch('/api/event/2/', data={'amount': '30'},
+                                 headers={'If-Match': etag})
+    assert response.status_code == 200
+    assert test_client.patch('/api/event/2/', data={'amount': '40'},
+                             headers={'If-Match': etag}).status_code == 409
+    assert test_client.get('/api/event/2/', headers={
+        'If-None-Match': etag}).status_code == 200
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires fork')
+def test_prefork_workers(test_client, monkeypatch):
+    """
+    Tests that a forked worker opens its own database on the configured file
+    and that its writes reach the parent's cached reads
+    """
+    assert main_api.get_db()._pool.filename == \
+        main_api.app.config['DATABASE']
+    main_api.close_db()
+    parent = main_api.get_db()
+    assert main_api.get_db() is parent
+
+    main_api.db.insert_person('Carl')
+    assert main_api.db.get_person_by_id(2) is None
+
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            child = main_api.get_db()
+            if child is not parent and child._pool.filename == \
+                    main_api.app.config['DATABASE']:
+                child.insert_person('Emily')
+                code = 0
+        finally:
+            os._exit(code)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+
+    assert main_api.get_db() is parent
+    assert main_api.db.get_person_by_id(2) == \
+        {'person_id': 2, 'name': 'Emily'}
+    response = test_client.get('/api/person/2')
+    assert json.loads(response.data) == {'person_id': 2, 'name': 'Emily'}
+
+
+def test_event_unknown_references(test_client):
+    """
+    Tests that an event for a person or activity that does not exist is
+    refused with 422 rather than failing the request
+    """
+    main_api.db.insert_person('Carl')
+    main_api.db.insert_activity('Birthday')
+
+    for person_id, activity_id in ((99, 1), (1, 99)):
+        response = test_client.post('/api/event/', data={
+            'person_id': person_id, 'activity_id': activity_id,
+            'date': 'May-24-2019', 'amount': 100})
+        assert response.status_code == 422
+        assert json.loads(response.data) == \
+            {'error': 'person or activity not found'}
+    assert main_api.db.get_all_events() == []
+
+
+def test_migrate_double_bookings(test_client):
+    """
+    Tests that migrating a file with double-booked events lists the clashing
+    events, and succeeds once they are moved
+    """
+    main_api.db.insert_person('Carl')
+    main_api.db.import_activities(['Birthday', 'Wedding'])
+    conn = sqlite3.connect(main_api.app.config['DATABASE'])
+    conn.execute('DROP INDEX ux_event_slot')
+    conn.executemany(
+        'INSERT INTO event(person_id, activity_id, date, amount_cents) '
+        'VALUES(1, ?, ?, 100)', [(1, '2019-05-01'), (2, '2019-05-01'),
+                                 (1, '2019-05-02'), (1, '2019-05-01')])
+    conn.commit()
+    conn.close()
+
+    with pytest.raises(booking_db.BookingConflict):
+        main_api.db.migrate()
+    assert main_api.db.double_bookings() == [(('2019-05-01',), [1, 2, 4])]
+
+    result = main_api.app.test_cli_runner().invoke(args=['migratedb'])
+    assert result.exit_code == 1
+    assert '2019-05-01: events 1, 2, 4' in result.output
+    assert 'are not refused' in result.output
+
+    for event_id, date in ((2, '2019-05-03'), (4, '2019-05-04')):
+        response = test_client.patch('/api/event/{}/'.format(event_id),
+                                     data={'date': date})
+        assert response.status_code == 200
+    result = main_api.app.test_cli_runner().invoke(args=['migratedb'])
+    assert result.exit_code == 0
+    assert test_client.patch('/api/event/2/', data={'date': '2019-05-01'}) \
+        .status_code == 409
+
+
+def test_restrict_without_foreign_keys(tmp_path):
+    """
+    Tests that restrict deletes still refuse to orphan events on connections
+    with foreign key enforcement turned off
+    """
+    db = booking_db.BookingDB(str(tmp_path / 'nofk.sqlite'),
+                              pragmas={'foreign_keys': 'OFF'})
+    db.create_tables()
+    db.import_people(['Carl', 'Emily'])
+    db.import_activities(['Birthday'])
+    db.insert_event(1, 1, '2019-05-01', 10)
+
+    with pytest.raises(booking_db.StillReferenced):
+        db.delete_people([2, 1])
+    with pytest.raises(booking_db.StillReferenced):
+        db.delete_activity(1)
+    assert len(db.get_all_people()) == 2
+    assert db.delete_people([2]) == ([{'person_id': 2, 'name': 'Emily'}], [])
+    db.close()
+
+
+def test_reports_follow_event_writes(tmp_path):
+    """
+    Tests that cached reports and people are refreshed by the writes that
+    change them
+    """
+    db = booking_db.BookingDB(str(tmp_path / 'reports.sqlite'))
+    db.create_tables()
+    db.import_people(['Carl'])
+    db.import_activities(['Birthday'])
+    db.insert_event(1, 1, '2019-05-01', 10)
+    assert [row['count'] for row in db.get_report('activity')] == [1]
+    db.insert_event(1, 1, '2019-05-02', 10)
+    assert [row['count'] for row in db.get_report('activity')] == [2]
+
+    assert db.get_person_by_id(1) == {'person_id': 1, 'name': 'Carl'}
+    hits = db.cache_info()['hits']
+    assert db.get_person_by_id(1) == {'person_id': 1, 'name': 'Carl'}
+    assert db.cache_info()['hits'] == hits + 1
+    db.close()
+
+
+def test_recreate_tables_with_events(tmp_path):
+    """
+    Tests that create_tables() can rebuild a database holding events while
+    foreign keys are enforced
+    """
+    db = booking_db.BookingDB(str(tmp_path / 'recreate.sqlite'))
+    db.create_tables()
+    db.import_people(['Carl'])
+    db.import_activities(['Birthday'])
+    db.insert_event(1, 1, '2019-05-01', 10)
+
+    db.create_tables()
+    assert db.get_all_events() == []
+    assert db.get_all_people() == []
+    db.close()
+
+
+def test_cache_sees_other_connections(test_client):
+    """
+    Tests that a write committed by another BookingDB on the same file
+    reaches both the cached body and the ETag of the next request
+    """
+    main_api.db.insert_person('Carl')
+    response = test_client.get('/api/person/')
+    etag = response.headers['ETag']
+    assert len(json.loads(response.data)) == 1
+
+    other = booking_db.BookingDB(main_api.app.config['DATABASE'])
+    other.insert_person('Emily')
+    other.close()
+
+    response = test_client.get('/api/person/', headers={
+        'If-None-Match': etag})
+    assert response.status_code == 200
+    assert [person['name'] for person in json.loads(response.data)] == \
+        ['Carl', 'Emily']
+    assert response.headers['ETag'] != etag
+    assert main_api.db.get_person_by_id(2) == \
+        {'person_id': 2, 'name': 'Emily'}